@@ -38,14 +38,43 @@
 #these are the modules needed for all the code in this project: #
 
 import xml.etree.cElementTree as ET
+from xml.parsers import expat
 import pprint
 import re
-from collections import defaultdict
+import string
+import timeit
+from collections import defaultdict, deque
 import pandas as pd
+import bz2
 import csv
 import codecs
+import calendar
+import difflib
+import gzip
+import io
+import itertools
+import json
+import math
+import operator
+import os
+import random
+import resource
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import zlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import Queue
 import sqlite3
 import numpy as np
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # only needed for process_map(..., columnar=...)
+    pa = pq = None
 import matplotlib as plt
 get_ipython().magic(u'matplotlib inline')
 
@@ -56,22 +85,311 @@ out_file = 'seattle_fixed.osm'
 sample_testing_file ='sample_testing.osm'
 
 
+# The extracts from Geofabrik and Overpass come as .osm.bz2.  open_osm() lets everything that reads
+# an OSM file take the compressed file as it is (.bz2 or .gz) and decompresses it while the parser
+# streams through it, so the 1.61 GB .osm never has to be on disk.  bz2 is slow to decompress, often
+# slower than the parsing, but a multistream .bz2 (pbzip2 and lbzip2 write one stream per block) is
+# a run of independent streams: with DECOMPRESS_WORKERS > 1 they are decompressed a few MB at a time
+# in a process pool and handed to the parser in file order.
+
+# In[ ]:
+
+DECOMPRESS_WORKERS = 1  # more than 1 decompresses multistream .bz2 files in parallel
+BZ2_BLOCK = 1024 * 1024
+BZ2_JOB_SIZE = 8 * 1024 * 1024  # compressed bytes per parallel job
+BZ2_STREAM_START = re.compile(br'BZh[1-9]1AY&SY')  # stream header + block magic
+COMPRESSED_SUFFIXES = ('.bz2', '.gz')
+
+
+def is_compressed(osm_file):
+    return isinstance(osm_file, basestring) and osm_file.endswith(COMPRESSED_SUFFIXES)
+
+
+def check_uncompressed(osm_file):
+    '''For the functions that seek around in the XML, which they can't do in a compressed or .pbf file'''
+    if is_compressed(osm_file) or is_pbf(osm_file):
+        raise ValueError('{} is not plain XML; this needs to seek in the file, so convert it first'.format(
+                         osm_file))
+
+
+class ChunkReader(object):
+    """File-like read() over an iterator of strings, e.g. the output of a decompressor"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+        self.pos = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            data = self.buffer[self.pos:] + ''.join(self.chunks)
+            self.buffer, self.pos = '', 0
+            return data
+        while len(self.buffer) - self.pos < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer = self.buffer[self.pos:] + chunk
+            self.pos = 0
+        data = self.buffer[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        if hasattr(self.chunks, 'close'):
+            self.chunks.close()
+
+
+def stream_ended(decompressor):
+    '''True if a BZ2Decompressor has seen the end of its stream (python 2 has no .eof)'''
+    try:
+        decompressor.decompress('')
+    except EOFError:
+        return True
+    return False
+
+
+def bz2_chunks(path, block_size=BZ2_BLOCK):
+    '''Decompress a bz2 file a block at a time, all of its streams (bz2.BZ2File stops after the first)'''
+    with open(path, 'rb') as f:
+        decompressor = bz2.BZ2Decompressor()
+        block = f.read(block_size)
+        while block:
+            if stream_ended(decompressor):  # the last stream ended right at the end of a block
+                decompressor = bz2.BZ2Decompressor()
+            data = decompressor.decompress(block)
+            if decompressor.unused_data:
+                block = decompressor.unused_data
+                decompressor = bz2.BZ2Decompressor()
+            else:
+                block = f.read(block_size)
+            yield data
+        if not stream_ended(decompressor):
+            raise IOError('{} ends in the middle of a bz2 stream'.format(path))
+
+
+def bz2_jobs(path, job_size=BZ2_JOB_SIZE):
+    '''Split path at bz2 stream headers into (path, start, end) ranges of about job_size bytes
+
+    A header-like pattern inside compressed data would make a wrong split;
+    parallel_bz2_chunks notices and decompresses around it.
+    '''
+    size = os.path.getsize(path)
+    starts, tail, offset = [], '', 0
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(BZ2_BLOCK)
+            if not block:
+                break
+            data = tail + block
+            starts.extend(offset - len(tail) + m.start() for m in BZ2_STREAM_START.finditer(data))
+            tail = data[-9:]
+            offset += len(block)
+    starts = sorted(set(starts) | set([0]))
+    cuts = [0]
+    for start in starts:
+        if start - cuts[-1] >= job_size:
+            cuts.append(start)
+    cuts.append(size)
+    streams = starts + [size]
+    largest = max(b - a for a, b in zip(streams, streams[1:])) if size else 0
+    return [(path, a, b) for a, b in zip(cuts, cuts[1:])], largest
+
+
+def decompress_bz2_range(job):
+    '''Pool worker: decompress the bz2 streams that start in [start, end) of path
+
+    The last one is read to its end even if that is past end.  Returns
+    (start, where the last stream ended, data), with data None if start is
+    not the start of a stream.
+    '''
+    path, start, end = job
+    out = []
+    with open(path, 'rb') as f:
+        f.seek(start)
+        block = f.read(end - start)
+        pos = end
+        decompressor = bz2.BZ2Decompressor()
+        try:
+            while True:
+                out.append(decompressor.decompress(block))
+                unused = decompressor.unused_data
+                if unused and pos - len(unused) < end:  # another stream starts inside the range
+                    block = unused
+                    decompressor = bz2.BZ2Decompressor()
+                elif unused or stream_ended(decompressor):
+                    return start, pos - len(unused), ''.join(out)
+                else:
+                    block = f.read(BZ2_BLOCK)
+                    if not block:
+                        raise IOError('{} ends in the middle of a bz2 stream'.format(path))
+                    pos += len(block)
+        except IOError:
+            if out:
+                raise
+            return start, start, None
+
+
+def bounded_imap(pool, func, jobs, ahead):
+    '''Like pool.imap, yielding (job, func(job)) in order, but with no more than ahead jobs out at once'''
+    jobs = iter(jobs)
+    pending = deque((job, pool.apply_async(func, (job,))) for job in itertools.islice(jobs, ahead))
+    while pending:
+        job, result = pending.popleft()
+        following = next(jobs, None)
+        if following is not None:
+            pending.append((following, pool.apply_async(func, (following,))))
+        yield job, result.get()
+
+
+def parallel_bz2_chunks(path, workers=DECOMPRESS_WORKERS, job_size=BZ2_JOB_SIZE):
+    '''Decompress a multistream bz2 file in a process pool, yielding the data in file order
+
+    At most 2 * workers jobs are out at once, so a slow parser doesn't let the
+    output pile up.  A file with streams much bigger than job_size (a plain
+    single-stream .bz2) is decompressed in this process with bz2_chunks.
+    '''
+    jobs, largest = bz2_jobs(path, job_size)
+    if len(jobs) < 2 or largest > 4 * job_size:
+        for data in bz2_chunks(path):
+            yield data
+        return
+    pool = multiprocessing.Pool(workers)
+    try:
+        done = 0  # everything before this has been yielded, and a stream starts here
+        for job, (start, end, data) in bounded_imap(pool, decompress_bz2_range, jobs, 2 * workers):
+            if job[2] <= done:
+                continue  # the job before read through all of this one
+            if start != done or data is None:
+                # a wrong split: start again from the last real stream end
+                start, end, data = decompress_bz2_range((path, done, job[2]))
+                if data is None:
+                    raise IOError('{}: bad bz2 data at byte {}'.format(path, done))
+            done = end
+            yield data
+    finally:
+        pool.terminate()
+
+
+def open_osm(osm_file, workers=None):
+    '''A file object for osm_file, decompressing as it is read if the name ends in .bz2 or .gz'''
+    if hasattr(osm_file, 'read'):
+        return osm_file
+    if osm_file.endswith('.bz2'):
+        workers = DECOMPRESS_WORKERS if workers is None else workers
+        if workers > 1:
+            return ChunkReader(parallel_bz2_chunks(osm_file, workers))
+        return ChunkReader(bz2_chunks(osm_file))
+    if osm_file.endswith('.gz'):
+        return gzip.open(osm_file, 'rb')
+    return open(osm_file, 'rb')
+
+#DECOMPRESS_WORKERS = multiprocessing.cpu_count()
+#in_file = 'seattle_washington.osm.bz2'
+
+
 # In[3]:
 
-# this is the generator function used to iterate across the OSM file, written by Udacity #
+# Everything that reads an OSM file goes through iterparse_elements (or the expat backend further
+# down).  It clears every top level element out of the tree once it is finished with it, the ones
+# that weren't asked for too - clearing only after a yield kept all of the ways and relations of a
+# tags=('node',) pass in memory.  memory_probe.start(name) switches on sampling of the RSS every
+# MEMORY_SAMPLE_EVERY elements and of how many elements the tree is still holding (iterparse reads
+# ahead, so that is up to a hundred or so, however long the file).
 
-def get_element(osm_file, tags=('node', 'way', 'relation')):
+MEMORY_SAMPLE_EVERY = 10000
+
+
+def current_rss():
+    '''Resident set size of this process in bytes, or None where /proc is missing'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def peak_rss():
+    '''Peak resident set size of this process in bytes (ru_maxrss is in kB on Linux, bytes on OS X)'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class MemoryProbe(object):
+    """RSS and retained element counts per stage, sampled by the parser backends
+
+    Does nothing until start(name); stop() switches it off again and returns
+    that stage's stats, which are also kept in self.stages[name].
+    """
+
+    def __init__(self, every=MEMORY_SAMPLE_EVERY):
+        self.every = every
+        self.enabled = False
+        self.stages = {}
+        self.stats = None
+        self.countdown = every
+
+    def start(self, name):
+        rss = current_rss() or 0
+        self.stats = {'elements': 0, 'samples': 0, 'start_rss': rss, 'peak_rss': rss, 'max_retained': 0}
+        self.stages[name] = self.stats
+        self.countdown = self.every
+        self.enabled = True
+
+    def count(self, retained):
+        '''Called by a parser for each top level element it finishes, with how many it is still holding'''
+        stats = self.stats
+        stats['elements'] += 1
+        if retained > stats['max_retained']:
+            stats['max_retained'] = retained
+        self.countdown -= 1
+        if not self.countdown:
+            self.countdown = self.every
+            self.sample()
+
+    def sample(self):
+        self.stats['samples'] += 1
+        self.stats['peak_rss'] = max(self.stats['peak_rss'], current_rss() or 0)
+
+    def stop(self):
+        self.sample()
+        self.enabled = False
+        return self.stats
+
+memory_probe = MemoryProbe()
+
+
+def iterparse_elements(osm_file, tags=('node', 'way', 'relation')):
     """Yield element if it is the right type of tag
 
     Reference:
     http://stackoverflow.com/questions/3095434/inserting-newlines-in-xml-file-generated-via-xml-etree-elementtree-in-python
     """
-    context = iter(ET.iterparse(osm_file, events=('start', 'end')))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+    source = open_osm(osm_file) if is_compressed(osm_file) else osm_file
+    try:
+        context = iter(ET.iterparse(source, events=('start', 'end')))
+        _, root = next(context)
+        depth = 0
+        for event, elem in context:
+            if event == 'start':
+                depth += 1
+                continue
+            depth -= 1
+            if not depth:  # a child of <osm> is finished
+                if elem.tag in tags:
+                    yield elem
+                if memory_probe.enabled:
+                    memory_probe.count(len(root))
+                root.clear()
+    finally:
+        if source is not osm_file:
+            source.close()
+
+# this is the generator function used to iterate across the OSM file, written by Udacity #
+
+def get_element(osm_file, tags=('node', 'way', 'relation')):
+    """Yield element if it is the right type of tag"""
+    return iterparse_elements(osm_file, tags)
 
 # this is the function written to write a sample file #
 def create_sample_file(in_file, out_file, k=30000):
@@ -127,7 +445,6 @@ better_st_name = {'Mcgarigle':'Mcgarigle Road',
     'Myrtle':'Myrtle Street',
     'Murdock':'Murdock Street',
     'Laventure' :  'North Laventure Road',
-    'Cleveland': 'Cleveland Avenue',
               'SE':'Southeast',
               'NW':'Northwest',
               'NE': 'Northeast',
@@ -166,7 +483,6 @@ better_st_name = {'Mcgarigle':'Mcgarigle Road',
               'N.E.':'Northeast',
               'S.E.':'Southeast',
               'av.':'Avenue',
-              'se':'Southeast',
               'Ct':'Court',
               "Blvd.":'Boulevard',
               'WY':'Way'}
@@ -189,10 +505,10 @@ def is_thing(elem, re_comp):
 def audit_k_name(filename, k_attrib):
     '''Make a set of street names that don't conform to list'''
     not_good = []
-    for i, elem in ET.iterparse(filename):
-        if elem.tag == 'tag':
-            if elem.attrib['k'] in k_attrib:
-                sn = street_name.match(elem.attrib['v'])
+    for elem in get_element(filename):
+        for tag in elem.findall('tag'):
+            if tag.attrib['k'] in k_attrib:
+                sn = street_name.match(tag.attrib['v'])
                 if sn:
                     street_type = sn.group(0)
                     if street_type not in OK_streets:
@@ -214,22 +530,11 @@ not_good = audit_k_name(in_file) #contains list of unique attributes that don't
 
 def detail_bad_names(filename, not_good): 
     '''Print details of bad street name tags/parents'''
-    for i, elem in ET.iterparse(filename):
-        if elem.tag == 'node':
-            for tag in elem.findall('tag'):
-                if tag.attrib['k'] in k_add_fields:
-                    if tag.attrib['v'] in not_good:
-                        print tag.attrib
-        if elem.tag == 'way':
-            for tag in elem.findall('tag'):
-                if tag.attrib['k']in k_add_fields:
-                    if tag.attrib['v'] in not_good:
-                        print tag.attrib
-        if elem.tag == 'relationships':
-            for tag in elem.findall('tag'):
-                if tag.attrib['k'] in k_add_fields:
-                    if tag.attrib['v'] in not_good:
-                        print tag.attrib
+    for elem in get_element(filename):
+        for tag in elem.findall('tag'):
+            if tag.attrib['k'] in k_add_fields:
+                if tag.attrib['v'] in not_good:
+                    print tag.attrib
 
 
 def contains_thing(infile):
@@ -343,14 +648,13 @@ def audit_addresses(filename):
 def audit_lat_lon(filename, tag):
     lat_correct = re.compile(r'(\d{2}.\d{3,})')
     lon_correct = re.compile(r'(\-\d{3}.\d{3,})')
-    for i, elem in ET.iterparse(filename):
-        if elem.tag == tag:
-            lat = lat_correct.match(elem.attrib['lat'])
-            lon = lon_correct.match(elem.attrib['lon'])
-            if not lat:
-                print elem.attrib
-            if not lon:
-                print elem.attrib  
+    for elem in get_element(filename, tags=(tag,)):
+        lat = lat_correct.match(elem.attrib['lat'])
+        lon = lon_correct.match(elem.attrib['lon'])
+        if not lat:
+            print elem.attrib
+        if not lon:
+            print elem.attrib  
 
 
 # <b> Useful Link for lat/lon verification </b>
@@ -381,44 +685,439 @@ def update_name(name, mapping):
         return new_name
     except:
         return name
-    
-
-
-def write_new_file(infile, outfile):
-    '''writes a new OSM file with fixed street names'''
-    with open(outfile, 'w') as outfile:
-        outfile.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-        outfile.write('<osm>\n  ')
-        counter = 0
-        for element in get_element(infile):
-            if element.tag == 'node':
-                if element.findall('tag'):  
-                    for node in element:
-                        if node.attrib['k'] == 'addr:street': 
-                            new_name = update_name(node.attrib['v'], better_st_name)
-                            node.attrib['v'] = new_name
-                    outfile.write(ET.tostring(element, encoding='utf-8'))
-                    outfile.write('</node>\n    ')
-                if element.findall('tag') == []:
-                    outfile.write(ET.tostring(element, encoding='utf-8'))
-            if element.tag == 'way':
-                element_top = ET.tostringlist(element, encoding='utf-8')
-                outfile.write(''.join(map(str, element_top[0:8])))
-                outfile.write('\n        ')
-                for node in element:
-                    if node.tag == 'tag':
-                        if node.attrib['k'] == 'addr:street':
-                            new_name = update_name(node.attrib['v'], better_st_name)
-                            node.attrib['v'] = new_name
-                            outfile.write(ET.tostring(node, encoding = 'utf-8'))
-                        else:
-                            outfile.write(ET.tostring(node, encoding='utf-8'))
+
+
+# update_name runs a regex search and a re.sub for every addr:street tag, even though the same
+# street names come up thousands of times. StreetNormalizer makes the same fix with plain string
+# operations, checks the mapping once up front and remembers the streets it has already fixed.
+
+# In[ ]:
+
+class LRUCache(object):
+    """Dict with a maximum size that drops the least recently used key when full
+
+    Entries live in a circular doubly linked list of [prev, next, key, value]
+    lists (the layout functools.lru_cache uses in Python 3), so a hit is one
+    dict lookup plus a few pointer swaps.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.links = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        link = self.links.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        # unlink, then re-insert just before root as the most recently used entry
+        link_prev, link_next = link[0], link[1]
+        link_prev[1] = link_next
+        link_next[0] = link_prev
+        root = self.root
+        last = root[0]
+        last[1] = root[0] = link
+        link[0] = last
+        link[1] = root
+        return link[3]
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        root = self.root
+        link = self.links.pop(key, None)
+        if link is not None:
+            link[0][1] = link[1]
+            link[1][0] = link[0]
+        elif len(self.links) >= self.maxsize:
+            oldest = root[1]
+            root[1] = oldest[1]
+            oldest[1][0] = root
+            del self.links[oldest[2]]
+        last = root[0]
+        link = [last, root, key, value]
+        last[1] = root[0] = link
+        self.links[key] = link
+
+    def __len__(self):
+        return len(self.links)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.links),
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+
+class StreetNormalizer(object):
+    """Same fix as update_name(name, mapping), built once from the mapping
+
+    The mapping is checked when the normalizer is made: a key listed twice, a
+    key that can never be the last word of a street, or a fix whose own last
+    word would be changed again on a second run all raise ValueError.
+    """
+    WHITESPACE = ' \t\n\r\f\v'
+    WORD_CHARS = frozenset(string.ascii_letters + string.digits + '_')
+
+    def __init__(self, mapping, cache_size=100000):
+        pairs = mapping.items() if hasattr(mapping, 'items') else mapping
+        self.mapping = self.validate(pairs)
+        self.cache = LRUCache(cache_size)
+
+    @classmethod
+    def split_suffix(cls, name):
+        '''Return (start, end) of the part of name that street_name matches, or None'''
+        end = len(name)
+        if end and name[-1] == '\n':  # $ also matches just before a trailing newline
+            end -= 1
+        start = end
+        while start and name[start - 1] not in cls.WHITESPACE:
+            start -= 1
+        while start < end and name[start] not in cls.WORD_CHARS:
+            start += 1
+        if start == end:
+            return None
+        return start, end
+
+    @classmethod
+    def validate(cls, pairs):
+        '''Turn (abbreviation, fix) pairs into a dict, raising ValueError if any of them are bad'''
+        mapping = {}
+        problems = []
+        for key, value in pairs:
+            if key in mapping:
+                if mapping[key] == value:
+                    problems.append('{!r} is listed twice'.format(key))
+                else:
+                    problems.append('{!r} maps to both {!r} and {!r}'.format(key, mapping[key], value))
+            if cls.split_suffix(key) != (0, len(key)):
+                problems.append('{!r} can never be the last word of a street'.format(key))
+            mapping[key] = value
+        for key, value in sorted(mapping.items()):
+            span = cls.split_suffix(value)
+            if span:
+                suffix = value[span[0]:span[1]]
+                if mapping.get(suffix, suffix) != suffix:
+                    problems.append('{!r} -> {!r} would be changed again to end in {!r}'.format(
+                        key, value, mapping[suffix]))
+        if problems:
+            raise ValueError('bad street name mapping:\n' + '\n'.join(problems))
+        return mapping
+
+    def fix(self, name):
+        '''Uncached fix for one street name'''
+        span = self.split_suffix(name)
+        if span:
+            start, end = span
+            better = self.mapping.get(name[start:end])
+            if better is not None:
+                return name[:start] + better + name[end:]
+        return name
+
+    def normalize(self, name):
+        fixed = self.cache.get(name)
+        if fixed is None:
+            fixed = self.fix(name)
+            self.cache.put(name, fixed)
+        return fixed
+
+    def normalize_many(self, names):
+        '''Normalize a whole column of street names, each distinct name is only looked up once'''
+        names = list(names)
+        fixed = dict((name, self.normalize(name)) for name in set(names))
+        return [fixed[name] for name in names]
+
+    def stats(self):
+        return self.cache.stats()
+
+
+def street_names(filename):
+    '''List every addr:street value in filename, repeats included'''
+    return [tag.attrib['v'] for element in get_element(filename)
+            for tag in element.findall('tag') if tag.attrib['k'] == 'addr:street']
+
+
+def benchmark_street_normalizer(names, repeat=5):
+    '''Time update_name against StreetNormalizer on the same street names, return both times'''
+    normalizer = StreetNormalizer(better_st_name)
+    expected = [update_name(name, better_st_name) for name in names]
+    assert normalizer.normalize_many(names) == expected
+    assert [normalizer.normalize(name) for name in names] == expected
+    old = min(timeit.repeat(lambda: [update_name(name, better_st_name) for name in names],
+                            number=1, repeat=repeat))
+    new = min(timeit.repeat(lambda: [normalizer.normalize(name) for name in names],
+                            number=1, repeat=repeat))
+    batch = min(timeit.repeat(lambda: normalizer.normalize_many(names), number=1, repeat=repeat))
+    print '{} street names, {} distinct'.format(len(names), len(set(names)))
+    print 'update_name:                     {:.4f}s'.format(old)
+    print 'StreetNormalizer.normalize:      {:.4f}s ({:.1f}x)'.format(new, old / new)
+    print 'StreetNormalizer.normalize_many: {:.4f}s ({:.1f}x)'.format(batch, old / batch)
+    print 'cache:', normalizer.stats()
+    return old, new
+
+street_normalizer = StreetNormalizer(better_st_name)
+
+#benchmark_street_normalizer(street_names(in_file))
+
+
+# On the full download process_map, write_new_file and load_db run for a long time without a word.
+# After instrumentation.start(), each of them counts what it does as it goes: bytes read from the
+# input, elements of each type, tags shaped, rows per output table, and the time spent waiting for
+# the parser, shaping and writing.  A progress line goes to stderr every PROGRESS_INTERVAL seconds
+# and a json summary when the stage ends.  Switched off (the default) the stages take their usual
+# path and the only cost is one check per call.
+
+# In[ ]:
+
+PROGRESS_INTERVAL = 10  # seconds
+
+
+class CountingFile(object):
+    """Read-only file wrapper that counts the bytes handed to the parser (after any decompression)"""
+
+    def __init__(self, path):
+        self.f = open_osm(path)
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.bytes += len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+class StageCounters(object):
+    """Counters for one run of one stage; run() drives the stage's parse - shape - write loop
+
+    A stage whose middle step is not shape_rows (write_new_file edits the
+    elements) gives its own name for it, and its summary has no rows or tags.
+    """
+
+    def __init__(self, name, file_in, instrumentation, middle='shape'):
+        self.name = name
+        self.steps = ('parse', middle, 'write')
+        self.instrumentation = instrumentation
+        # the size of a compressed file says nothing about how much the parser will get out of it
+        self.total_bytes = (os.path.getsize(file_in) if isinstance(file_in, basestring) and
+                            not is_compressed(file_in) else None)
+        self.file = CountingFile(file_in) if isinstance(file_in, basestring) and not is_pbf(file_in) else None
+        self.elements = defaultdict(int)
+        self.rows = defaultdict(int)
+        self.tags = 0
+        self.seconds = dict.fromkeys(self.steps, 0.0)
+        self.started = self.last_report = time.time()
+
+    def source(self, file_in):
+        '''What the parser should read: the counted file if there is one'''
+        return self.file if self.file is not None else file_in
+
+    def run(self, elements, shape, write):
+        '''For each element: rows = shape(element), then write(element, rows), timing all three steps
+
+        Time spent getting the next element out of elements (parsing, and any
+        clipping or geometry tracking on the way) counts as parse time.
+        '''
+        clock = time.time
+        seconds = self.seconds
+        middle = self.steps[1]
+        shaping = middle == 'shape'
+        interval = self.instrumentation.interval
+        before = clock()
+        for element in elements:
+            parsed = clock()
+            rows = shape(element)
+            shaped = clock()
+            write(element, rows)
+            written = clock()
+            seconds['parse'] += parsed - before
+            seconds[middle] += shaped - parsed
+            seconds['write'] += written - shaped
+            self.elements[element.tag] += 1
+            if shaping and rows:
+                for key, value in rows.items():
+                    if key in ENTITY_KEYS:
+                        self.rows[key] += 1
                     else:
-                        outfile.write(ET.tostring(node, encoding = 'utf-8'))
-                outfile.write('</way>\n    ')
-            if element.tag == 'relation':
-                ET.tostring(element, encoding='utf-8')
-        outfile.write('</osm>')
+                        self.rows[key] += len(value)
+                        if key in TAG_ENTITY:
+                            self.tags += len(value)
+            if written - self.last_report >= interval:
+                self.last_report = written
+                self.instrumentation.write(self.progress())
+            before = written
+
+    def summary(self):
+        elapsed = max(time.time() - self.started, 1e-9)
+        busy = sum(self.seconds.values()) or 1e-9
+        summary = {'stage': self.name, 'seconds': elapsed,
+                   'bytes': self.file.bytes if self.file is not None else None, 'total_bytes': self.total_bytes,
+                   'elements': dict(self.elements),
+                   'elements_per_sec': dict((kind, n / elapsed) for kind, n in self.elements.items()),
+                   'split_seconds': dict(self.seconds),
+                   'split': dict((step, s / busy) for step, s in self.seconds.items())}
+        if self.steps[1] == 'shape':
+            summary['tags'] = self.tags
+            summary['rows'] = dict(self.rows)
+        return summary
+
+    def progress(self):
+        '''One line for stderr: how far through the input, how fast and where the time goes'''
+        summary = self.summary()
+        done = ''
+        if summary['bytes'] is not None:
+            done = '%.1f MB' % (summary['bytes'] / 1048576.0)
+            if summary['total_bytes']:
+                done += ' of %.1f MB (%.1f%%)' % (summary['total_bytes'] / 1048576.0,
+                                                  100.0 * summary['bytes'] / summary['total_bytes'])
+        rates = ' '.join('%s %.0f/s' % (kind, summary['elements_per_sec'][kind])
+                         for kind in ENTITY_KEYS if kind in summary['elements_per_sec'])
+        split = ' '.join('%s %.0f%%' % (step, 100 * summary['split'][step]) for step in self.steps)
+        return '%s: %s  %d elements in %.0fs (%s)  %s' % (self.name, done, sum(self.elements.values()),
+                                                         summary['seconds'], rates, split)
+
+    def finish(self):
+        '''Print the json summary to stderr (and append it to the summary file), return it'''
+        if self.file is not None:
+            self.file.close()
+        summary = self.summary()
+        self.instrumentation.write(self.progress())
+        self.instrumentation.write(json.dumps(summary, sort_keys=True))
+        self.instrumentation.summaries.append(summary)
+        if self.instrumentation.summary_path:
+            with open(self.instrumentation.summary_path, 'a') as f:
+                f.write(json.dumps(summary, sort_keys=True) + '\n')
+        return summary
+
+
+class Instrumentation(object):
+    """Switch for the throughput counters of process_map, write_new_file and load_db
+
+    start() turns them on; each stage run after that calls stage() for a
+    StageCounters.  The summary of every finished stage is kept in
+    self.summaries and, with summary_path, appended to that file as json lines.
+    """
+
+    def __init__(self, interval=PROGRESS_INTERVAL, stream=None):
+        self.enabled = False
+        self.interval = interval
+        self.stream = stream
+        self.summary_path = None
+        self.summaries = []
+
+    def start(self, interval=PROGRESS_INTERVAL, summary_path=None):
+        self.enabled = True
+        self.interval = interval
+        self.summary_path = summary_path
+
+    def stop(self):
+        self.enabled = False
+        return self.summaries
+
+    def stage(self, name, file_in, middle='shape'):
+        return StageCounters(name, file_in, self, middle)
+
+    def write(self, line):
+        (self.stream or sys.stderr).write(line + '\n')
+
+instrumentation = Instrumentation()
+
+#instrumentation.start(summary_path='stages.json')
+
+
+# write_new_file used to serialize every child separately with ET.tostring, dropped all of the
+# relations and wrote a stray </node> after tagged nodes. OSMWriter streams the elements out
+# itself through one big write buffer, and the street name fix is just an edit hook.
+
+# In[ ]:
+
+OUTPUT_BUFFER = 1024 * 1024
+XML_SPECIAL = re.compile(r'[&<>"\n\r\t]')
+
+
+def escape_attrib(value):
+    '''Escape an attribute value for writing between double quotes'''
+    if XML_SPECIAL.search(value) is None:
+        return value
+    return (value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+            .replace('\n', '&#10;').replace('\r', '&#13;').replace('\t', '&#9;'))
+
+
+def element_parts(elem, parts, indent='  '):
+    '''Append the pieces of elem (and its children) as OSM XML to parts'''
+    parts.append(indent + '<' + elem.tag)
+    for k, v in sorted(elem.attrib.items()):
+        parts.append(' %s="%s"' % (k, escape_attrib(v)))  # % rather than format(), it copes with unicode
+    if len(elem):
+        parts.append('>\n')
+        for child in elem:
+            element_parts(child, parts, indent + '  ')
+        parts.append(indent + '</' + elem.tag + '>\n')
+    else:
+        parts.append(' />\n')
+
+
+class OSMWriter(object):
+    """Write elements from get_element to a new OSM file, one buffered write per element
+
+    Use it as a context manager; the closing </osm> tag is only written if the
+    block finishes without an error, so a half written file never looks complete.
+    """
+
+    def __init__(self, outfile, buffer_size=OUTPUT_BUFFER):
+        self.f = open(outfile, 'wb', buffer_size)
+        self.f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm>\n')
+
+    def write(self, elem):
+        parts = []
+        element_parts(elem, parts)
+        data = ''.join(parts)
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.f.write(data)
+
+    def close(self):
+        self.f.write('</osm>\n')
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.f.close()
+
+
+def fix_street_names(elem):
+    '''Edit hook for write_new_file: fix every addr:street tag with street_normalizer'''
+    for tag in elem.findall('tag'):
+        if tag.attrib['k'] == 'addr:street':
+            tag.attrib['v'] = street_normalizer.normalize(tag.attrib['v'])
+
+
+def write_new_file(infile, outfile, edit=fix_street_names):
+    '''writes a new OSM file with every node, way and relation, after edit(element) has fixed it up'''
+    stage = instrumentation.stage('write_new_file', infile, 'edit') if instrumentation.enabled else None
+    try:
+        with OSMWriter(outfile) as writer:
+            if stage is None:
+                for element in get_element(infile):
+                    if edit:
+                        edit(element)
+                    writer.write(element)
+            else:
+                stage.run(get_element(stage.source(infile)), edit or (lambda element: None),
+                          lambda element, _: writer.write(element))
+    finally:
+        if stage is not None:
+            stage.finish()
  
 
 
@@ -448,11 +1147,174 @@ def count_elements(infile):
             num_way += 1
         if element.tag == 'relation':
             num_relation += 1
-    print 'file:' '{} {}{} {}{} {}{}'.format(in_file, 'number of ways:', num_way, 'number of JOSM:', 
-                              num_JOSM,'number of relations:', num_relation)
+    print 'file:' '{} {}{} {}{} {}{} {}{}'.format(infile, 'number of nodes:', num_node, 'number of ways:', num_way,
+                              'number of JOSM:', num_JOSM,'number of relations:', num_relation)
+    return num_node, num_way, num_relation, num_JOSM
+
+
+def check_round_trip(infile, outfile):
+    '''True if outfile has the same number of nodes, ways, relations and JOSM tags as infile'''
+    return count_elements(infile) == count_elements(outfile)
             
 # at one point I was concerned about the JOSM entries, but they checked out OK.
 # count_elements(in_file), count_elements(out_file) 
+# check_round_trip(in_file, out_file)
+
+
+# Each of the audits above parses the whole file on its own, so running all of them on the full
+# download means six passes over 1.61 GB of XML. Below, every audit is written as a visitor
+# instead and run_audits() feeds one get_element() pass to all of them at once.
+
+# In[ ]:
+
+class AuditVisitor(object):
+    """Base class for an audit that run_audits() can drive
+
+    tags is the set of top level elements the audit wants to see, visit() is
+    called once for each of them and result() is collected at the end.
+    """
+    name = None
+    tags = ('node', 'way', 'relation')
+
+    def visit(self, elem):
+        pass
+
+    def result(self):
+        return None
+
+
+class StreetTypeAudit(AuditVisitor):
+    '''Same check as audit_k_name: street types that are not in OK_streets'''
+    name = 'street_types'
+
+    def __init__(self, k_attrib):
+        self.k_attrib = k_attrib
+        self.not_good = set()
+
+    def visit(self, elem):
+        for tag in elem.findall('tag'):
+            if tag.attrib['k'] in self.k_attrib:
+                sn = street_name.match(tag.attrib['v'])
+                if sn and sn.group(0) not in OK_streets:
+                    self.not_good.add(sn.group(0))
+
+    def result(self):
+        return self.not_good
+
+
+class AddressAudit(AuditVisitor):
+    '''Same checks as audit_addresses: city, housenumber and postcode formats'''
+    name = 'addresses'
+    tags = ('node', 'way')
+
+    def __init__(self):
+        self.checks = {'addr:city': re.compile(r'([a-zA-z]*)'),
+                       'addr:housenumber': re.compile(r'(\d*)'),
+                       'addr:postcode': re.compile(r'(\d{5})')}
+        self.problems = []
+
+    def visit(self, elem):
+        for tag in elem.findall('tag'):
+            check = self.checks.get(tag.attrib['k'])
+            if check and not check.match(tag.attrib['v']):
+                self.problems.append(tag.attrib)
+
+    def result(self):
+        return self.problems
+
+
+class LatLonAudit(AuditVisitor):
+    '''Same check as audit_lat_lon: attributes of elements with odd lat/lon values'''
+    name = 'lat_lon'
+    lat_correct = re.compile(r'(\d{2}.\d{3,})')
+    lon_correct = re.compile(r'(\-\d{3}.\d{3,})')
+
+    def __init__(self, tag='node'):
+        self.tags = (tag,)
+        self.wonky = []
+
+    def visit(self, elem):
+        if not (self.lat_correct.match(elem.attrib['lat']) and
+                self.lon_correct.match(elem.attrib['lon'])):
+            self.wonky.append(elem.attrib)
+
+    def result(self):
+        return self.wonky
+
+
+class BadNameAudit(AuditVisitor):
+    '''Same as detail_bad_names: tags whose street value is in not_good'''
+    name = 'bad_names'
+
+    def __init__(self, k_fields, not_good):
+        self.k_fields = k_fields
+        self.not_good = not_good
+        self.bad = []
+
+    def visit(self, elem):
+        for tag in elem.findall('tag'):
+            if tag.attrib['k'] in self.k_fields and tag.attrib['v'] in self.not_good:
+                self.bad.append(tag.attrib)
+
+    def result(self):
+        return self.bad
+
+
+class KeyMatchAudit(AuditVisitor):
+    '''Same as contains_thing: set of tag keys that match re_comp'''
+    name = 'key_matches'
+
+    def __init__(self, re_comp, tag='node'):
+        self.re_comp = re_comp
+        self.tags = (tag,)
+        self.keys = set()
+
+    def visit(self, elem):
+        for tag in elem.findall('tag'):
+            if is_thing(tag.attrib['k'], self.re_comp):
+                self.keys.add(tag.attrib['k'])
+
+    def result(self):
+        return self.keys
+
+
+class ElementCountAudit(AuditVisitor):
+    '''Same as count_elements: number of nodes, ways, relations and JOSM node tags'''
+    name = 'counts'
+
+    def __init__(self):
+        self.counts = {'node': 0, 'way': 0, 'relation': 0, 'JOSM': 0}
+
+    def visit(self, elem):
+        self.counts[elem.tag] += 1
+        if elem.tag == 'node':
+            for tag in elem.findall('tag'):
+                if tag.attrib['v'] == 'JOSM':
+                    self.counts['JOSM'] += 1
+
+    def result(self):
+        return self.counts
+
+
+def run_audits(filename, audits):
+    '''Run all of the audits over filename in one pass, return {audit.name: result}'''
+    names = [audit.name for audit in audits]
+    if len(set(names)) != len(names):
+        raise ValueError('audit names must be unique: {}'.format(names))
+    by_tag = defaultdict(list)
+    for audit in audits:
+        for tag in audit.tags:
+            by_tag[tag].append(audit)
+    for element in get_element(filename, tags=tuple(by_tag)):
+        for audit in by_tag[element.tag]:
+            audit.visit(element)
+    return dict((audit.name, audit.result()) for audit in audits)
+
+# BadNameAudit needs the street types found by StreetTypeAudit, so it has to go in a second run
+#audits = [StreetTypeAudit(['addr:street']), AddressAudit(), LatLonAudit('node'),
+#          KeyMatchAudit(match_way), ElementCountAudit()]
+#results = run_audits(in_file, audits)
+#bad_names = run_audits(in_file, [BadNameAudit(['addr:street'], results['street_types'])])
 
 
 # Write files to csv for import into Sqlite3
@@ -481,197 +1343,1486 @@ in_file = 'seattle_fixed.osm'
 
 # Make sure the fields order in the csvs matches the column order in the sql table schema
 NODE_FIELDS = ['id', 'lat', 'lon', 'user', 'uid', 'version', 'changeset', 'timestamp']
-NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
+NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type', 'norm']
 WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
-WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
+WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type', 'norm']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
-REL_TAGS_FIELDS = ['id','key','value','type']
-REL_MEMBERS_FIELDS = ['reference', 'role', 'type']
+REL_TAGS_FIELDS = ['id','key','value','type', 'norm']
+REL_MEMBERS_FIELDS = ['id', 'reference', 'role', 'type']
 REL_FIELDS = ['id','user','uid','version','changeset', 'timestamp']
 
 
-def shape_element(elem):   
-    node_attribs = dict.fromkeys(NODE_FIELDS) #dictionary of node parent
-    ways_attribs = dict.fromkeys(WAY_FIELDS) #dictionary of ways parent
-    node_tags= [] #list of dictionaries of node parent, tags children
-    way_tags = [] #list of dictionaries of way parent, tags children
-    way_nodes = [] # list of dictionaries of way parent, nd children
-    rel_attribs = dict.fromkeys(REL_FIELDS)
-    rel_members = []
-    rel_tags = []
-    count = 0
+ENTITY_KEYS = ('node', 'way', 'relation')
+
+# shape_element output key -> csv path and fields
+CSV_OUTPUTS = [('node', NODES_PATH, NODE_FIELDS),
+               ('node_tags', NODE_TAGS_PATH, NODE_TAGS_FIELDS),
+               ('way', WAYS_PATH, WAY_FIELDS),
+               ('way_nodes', WAY_NODES_PATH, WAY_NODES_FIELDS),
+               ('way_tags', WAY_TAGS_PATH, WAY_TAGS_FIELDS),
+               ('relation', RELS_PATH, REL_FIELDS),
+               ('rel_members', REL_MEMBERS_PATH, REL_MEMBERS_FIELDS),
+               ('rel_tags', REL_TAGS_PATH, REL_TAGS_FIELDS)]
+OUTPUT_FIELDS = dict((key, fields) for key, _, fields in CSV_OUTPUTS)
+
+get_node_fields = operator.itemgetter(*NODE_FIELDS)
+get_way_fields = operator.itemgetter(*WAY_FIELDS)
+get_rel_fields = operator.itemgetter(*REL_FIELDS)
+
+
+def shape_rows(elem):
+    """Shape an element into plain tuples, in the same order as the *_FIELDS lists
+
+    Returns {'node': row, 'node_tags': [rows]} for a node, and the same for ways
+    (way, way_nodes, way_tags) and relations (relation, rel_members, rel_tags).
+    """
     if elem.tag == 'way':
         id_way = elem.attrib['id']
-        ways_attribs['id'] = elem.attrib['id']
-        ways_attribs['user'] = elem.attrib['user']
-        ways_attribs['uid'] = elem.attrib['uid']
-        ways_attribs['version'] = elem.attrib['version']
-        ways_attribs['changeset'] = elem.attrib['changeset']
-        ways_attribs['timestamp'] = elem.attrib['timestamp']
-        for node in elem:  
-            if node.tag =='tag':
-                t, k = parse_type_attrib(node)
-                if k == None:
-                    pass 
-                else:
-                    if t:
-                        way_dict = {'id' : id_way,
-                                     'value' : node.attrib['v'],
-                                     'key' : k,
-                                    'type' : t}
-                    else:
-                        way_dict = {'id' : id_way,
-                                     'value' : node.attrib['v'],
-                                     'key' : k,
-                                    'type' : 'regular'}
-                    way_tags.append(way_dict)
-            if node.tag == 'nd':
-                way_nodes_dict = {'id' : id_way,
-                                'node_id' : node.attrib['ref'],
-                                'position': count}
-                way_nodes.append(way_nodes_dict)
-                count += 1           
-        return {'way': ways_attribs, 'way_nodes': way_nodes, 'way_tags': way_tags}
+        way_nodes = []
+        way_tags = []
+        for child in elem:
+            if child.tag == 'nd':
+                way_nodes.append((id_way, child.attrib['ref'], len(way_nodes)))
+            elif child.tag == 'tag':
+                tag = tag_rules.apply(child.attrib['k'], child.attrib['v'])
+                if tag:
+                    way_tags.append((id_way,) + tag)
+        return {'way': get_way_fields(elem.attrib), 'way_nodes': way_nodes, 'way_tags': way_tags}
     if elem.tag == 'node':
-        if len(elem.attrib.keys())== 8:
-            id_node = elem.attrib['id']
-            node_attribs['id'] = elem.attrib['id']
-            node_attribs['user'] = elem.attrib['user']
-            node_attribs['lat'] = elem.attrib['lat']
-            node_attribs['lon'] = elem.attrib['lon']
-            node_attribs['uid'] = elem.attrib['uid']
-            node_attribs['version'] = elem.attrib['version']
-            node_attribs['changeset'] = elem.attrib['changeset']
-            node_attribs['timestamp'] = elem.attrib['timestamp']
-            for node in elem:
-                if node.tag == 'tag':
-                    t, k = parse_type_attrib(node)
-                    if k == None: 
-                        pass                 
-                    else:
-                        if t:
-                            node_dict = {'id' : id_node,
-                                 'value' : node.attrib['v'],
-                                 'key' : k,
-                                'type' : t}   
-                        else:
-                            node_dict = {'id' : id_node,
-                                 'value' : node.attrib['v'],
-                                 'key' : k,
-                                'type' : 'regular'}
-                            
-                        node_tags.append(node_dict)
-                else:
-                    node_tags.append([])       
-        return {'node': node_attribs, 'node_tags': node_tags}
+        if len(elem.attrib) != 8:
+            return {'node': (None,) * len(NODE_FIELDS), 'node_tags': []}
+        id_node = elem.attrib['id']
+        node_tags = []
+        for child in elem:
+            if child.tag == 'tag':
+                tag = tag_rules.apply(child.attrib['k'], child.attrib['v'])
+                if tag:
+                    node_tags.append((id_node,) + tag)
+        return {'node': get_node_fields(elem.attrib), 'node_tags': node_tags}
     if elem.tag == 'relation':
-            id_relation = elem.attrib['id']
-            rel_attribs['id'] = elem.attrib['id']
-            rel_attribs['user'] = elem.attrib['user']
-            rel_attribs['uid'] = elem.attrib['uid']
-            rel_attribs['version'] = elem.attrib['version']
-            rel_attribs['changeset'] = elem.attrib['changeset']
-            rel_attribs['timestamp'] = elem.attrib['timestamp']
-            for node in elem:
-                if node.tag == 'tag':
-                    t, k = parse_type_attrib(node)
-                    if k == None: 
-                        pass                 
-                    else:
-                        if t:
-                            rel_dict = {'id' : id_relation,
-                                 'value' : node.attrib['v'],
-                                 'key' : k,
-                                'type' : t}   
-                        else:
-                            rel_dict = {'id' : id_relation,
-                                 'value' : node.attrib['v'],
-                                 'key' : k,
-                                'type' : 'regular'}
-                            
-                        rel_tags.append(rel_dict)  
-                if node.tag == 'member':  
-                    rel_members_dict = {'reference' : node.attrib['ref'],
-                                        'role' : node.attrib['role'],
-                                        'type': node.attrib['type']} 
-                    rel_members.append(rel_members_dict) 
-            return {'relation': rel_attribs, 'rel_tags': rel_tags, 'rel_members': rel_members}
-        
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag"""
+        id_relation = elem.attrib['id']
+        rel_members = []
+        rel_tags = []
+        for child in elem:
+            if child.tag == 'member':
+                rel_members.append((id_relation, child.attrib['ref'], child.attrib['role'], child.attrib['type']))
+            elif child.tag == 'tag':
+                tag = tag_rules.apply(child.attrib['k'], child.attrib['v'])
+                if tag:
+                    rel_tags.append((id_relation,) + tag)
+        return {'relation': get_rel_fields(elem.attrib), 'rel_members': rel_members, 'rel_tags': rel_tags}
+
+
+def shape_element(elem):
+    '''Same as shape_rows but with every row as a dict of field -> value'''
+    rows = shape_rows(elem)
+    if rows:
+        shaped = {}
+        for key, value in rows.items():
+            fields = OUTPUT_FIELDS[key]
+            if key in ENTITY_KEYS:
+                shaped[key] = dict(zip(fields, value))
+            else:
+                shaped[key] = [dict(zip(fields, row)) for row in value]
+        return shaped
+
+
+# The iterparse backend builds a full ElementTree element for every node, way and relation, but
+# shape_element only ever looks at the tag, the attributes and the attributes of the children.
+# expat_elements gets those straight from expat callbacks into small OSMRecord objects instead.
+# Its strings are utf-8 byte strings rather than unicode, which is what the csv files want anyway.
+# cElementTree does its tree building in C while these callbacks run in Python, so which backend
+# is quicker depends on the interpreter and the file - benchmark_backends() measures it.
+
+PARSE_BLOCK = 1024 * 1024
+
+
+class OSMRecord(object):
+    """Lightweight stand-in for an ElementTree element: tag, attrib and child records"""
+    __slots__ = ('tag', 'attrib', 'children')
+
+    def __init__(self, tag, attrib, children=()):
+        self.tag = tag
+        self.attrib = attrib
+        self.children = children
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def __len__(self):
+        return len(self.children)
+
+    def findall(self, tag):
+        return [child for child in self.children if child.tag == tag]
+
+    def get(self, key, default=None):
+        return self.attrib.get(key, default)
+
+
+class ExpatCollector(object):
+    '''expat handlers that collect finished top level records in self.done'''
+
+    def __init__(self, tags):
+        self.tags = tags
+        self.done = []
+        self.current = None
+        self.depth = 0
+        self.current_depth = 0
+
+    def start(self, tag, attrib):
+        self.depth += 1
+        if self.current is not None:
+            self.current.children.append(OSMRecord(tag, attrib))
+        elif tag in self.tags:
+            self.current = OSMRecord(tag, attrib, [])
+            self.current_depth = self.depth
+
+    def end(self, tag):
+        if self.current is not None and self.depth == self.current_depth:
+            self.done.append(self.current)
+            self.current = None
+        self.depth -= 1
+
+
+def expat_elements(osm_file, tags=('node', 'way', 'relation'), block_size=PARSE_BLOCK):
+    '''Yield an OSMRecord for every element in tags, parsing osm_file with expat'''
+    collector = ExpatCollector(tags)
+    parser = expat.ParserCreate()
+    parser.returns_unicode = False
+    parser.StartElementHandler = collector.start
+    parser.EndElementHandler = collector.end
+    f = open_osm(osm_file)
+    try:
+        while True:
+            block = f.read(block_size)
+            parser.Parse(block, not block)
+            for record in collector.done:
+                yield record
+                if memory_probe.enabled:
+                    memory_probe.count(len(collector.done))
+            del collector.done[:]
+            if not block:
+                break
+    finally:
+        if f is not osm_file:
+            f.close()
+
+
+PARSER_BACKENDS = {'iterparse': iterparse_elements, 'expat': expat_elements}
+
+
+def get_element(osm_file, tags=('node', 'way', 'relation'), backend='iterparse'):
+    '''Yield every element in tags from osm_file using one of the PARSER_BACKENDS, or pbf_elements for a .pbf'''
+    if is_pbf(osm_file):
+        return pbf_elements(osm_file, tags)
+    return PARSER_BACKENDS[backend](osm_file, tags)
+
+
+def benchmark_backends(file_in, repeat=3):
+    '''Shape every element of file_in with each parser backend and print elements/sec'''
+    results = {}
+    for name in sorted(PARSER_BACKENDS):
+        counts = []
+
+        def run():
+            del counts[:]
+            for element in get_element(file_in, backend=name):
+                shape_rows(element)
+                counts.append(1)
+
+        seconds = min(timeit.repeat(run, number=1, repeat=repeat))
+        results[name] = len(counts) / seconds
+        print '{:10} {:,.0f} elements/sec'.format(name, results[name])
+    return results
+
+#benchmark_backends(in_file)
+
+
+# Reading the XML is the slowest part of every pass over the data.  The same extract as .osm.pbf
+# is about a tenth of the size, and is a run of independent zlib compressed blobs of a few thousand
+# elements each, so the blobs can be decoded in parallel (PBF_WORKERS).  There is no protobuf module
+# here, so pbf_elements() decodes the few messages it needs by hand: fields and varints in plain
+# Python, and the long packed, delta coded arrays of DenseNodes with numpy.  It yields the same
+# records as the iterparse backend: attributes as the OSM API writes them (lat and lon with trailing
+# zeros dropped - an XML file written with a fixed 7 decimals differs in that text), str for ascii and
+# unicode for anything else.  get_element() hands it any .pbf path, so process_map, load_db and the
+# audits work on either format.  History files are turned away, as deleted and old versions would
+# come out as live elements.
 
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+# In[ ]:
 
+PBF_WORKERS = 1  # more than 1 decodes the blobs in a process pool
+PBF_FEATURES = frozenset(['OsmSchema-V0.6', 'DenseNodes'])  # not HistoricalInformation: visible is not read
+PBF_MEMBER_TYPES = ('node', 'way', 'relation')
 
+_day_names = {}
 
-def parse_type_attrib(elem):      
-    before = re.compile(r'^([a-z]+):') #pattern to find ahead of :
-    tag_key = re.compile(r'^[a-z]+:([a-z]+:?[a-z]+.?[a-z]*)') #pattern to find after :
-    PROBLEMCHARS = re.compile(r'([=\+\/&<>;\'"\?%#$@\,\. \t\r\n])')
-    m = before.search(elem.attrib['k'])
-    l = tag_key.search(elem.attrib['k'])
-    pc = PROBLEMCHARS.search(elem.attrib['k'])
-    if pc:
-        t = None
-        k = None  
-        return t, k 
-        pass
-    if m:
-        
-        t = m.group(1)    
-    if l:
-        
-        k = l.group(1)   
+
+def is_pbf(osm_file):
+    return isinstance(osm_file, basestring) and osm_file.endswith('.pbf')
+
+
+def pbf_string(raw):
+    '''A string table entry the way ElementTree gives text: str if it is ascii, unicode otherwise'''
+    text = str(raw)
+    try:
+        text.decode('ascii')
+    except UnicodeDecodeError:
+        return text.decode('utf-8')
+    return text
+
+
+def read_varint(data, pos):
+    '''Decode the varint at data[pos] (data is a bytearray), return (value, position after it)'''
+    result = shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def zigzag(n):
+    '''sint32/sint64 value of a zigzag coded varint'''
+    return (n >> 1) ^ -(n & 1)
+
+
+def signed(n):
+    '''int32/int64 value of a varint, which holds negative numbers as 64 bit two's complement'''
+    return n - (1 << 64) if n >= 1 << 63 else n
+
+
+def pbf_fields(data, pos=0, end=None):
+    '''Yield (field number, value) for every field of the protobuf message in data[pos:end]
+
+    Varints come out as ints and length-delimited fields as (start, end)
+    offsets into data, so nothing is copied.
+    '''
+    end = len(data) if end is None else end
+    while pos < end:
+        key, pos = read_varint(data, pos)
+        wire = key & 7
+        if wire == 0:
+            value, pos = read_varint(data, pos)
+        elif wire == 2:
+            size, pos = read_varint(data, pos)
+            value = (pos, pos + size)
+            pos += size
+        elif wire == 1:
+            value = struct.unpack_from('<q', data, pos)[0]
+            pos += 8
+        elif wire == 5:
+            value = struct.unpack_from('<i', data, pos)[0]
+            pos += 4
+        else:
+            raise ValueError('unsupported protobuf wire type {}'.format(wire))
+        yield key >> 3, value
+
+
+def packed_varints(data, span):
+    '''Plain list of the varints in a packed field'''
+    pos, end = span
+    values = []
+    while pos < end:
+        value, pos = read_varint(data, pos)
+        values.append(value)
+    return values
+
+
+def delta_decode(values):
+    '''Running sum of zigzag coded deltas'''
+    total = 0
+    decoded = []
+    for value in values:
+        total += zigzag(value)
+        decoded.append(total)
+    return decoded
+
+
+def packed_array(data, span, zigzag_coded=False, delta=False):
+    '''Decode a long packed varint field with numpy, into an int64 array'''
+    raw = np.frombuffer(data, dtype=np.uint8)[span[0]:span[1]]
+    if not len(raw):
+        return np.zeros(0, dtype=np.int64)
+    last = raw < 0x80  # the last byte of each varint
+    varint = np.cumsum(last) - last  # which varint each byte belongs to
+    starts = np.flatnonzero(np.r_[True, last[:-1]])
+    shift = ((np.arange(len(raw)) - starts[varint]) * 7).astype(np.uint64)
+    values = np.add.reduceat((raw & 0x7f).astype(np.uint64) << shift, starts)
+    if zigzag_coded:
+        values = (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
     else:
-        
-        k = elem.attrib['k'] 
-        t = None
-    return t, k
+        values = values.astype(np.int64)
+    return np.cumsum(values) if delta else values
+
+
+def format_timestamp(seconds):
+    '''2016-02-27T00:03:41Z from seconds since the epoch'''
+    day, rest = divmod(seconds, 86400)
+    if day not in _day_names:
+        _day_names[day] = time.strftime('%Y-%m-%d', time.gmtime(day * 86400))
+    return '%sT%02d:%02d:%02dZ' % (_day_names[day], rest // 3600, rest // 60 % 60, rest % 60)
+
+
+class PrimitiveBlockDecoder(object):
+    """Turns one PBF PrimitiveBlock into (tag, attrib, children) tuples, children as (tag, attrib)"""
+
+    def __init__(self, data):
+        self.data = data
+        self.strings = []
+        self.groups = []
+        self.granularity, self.date_granularity = 100, 1000
+        self.lat_offset = self.lon_offset = 0
+        for field, value in pbf_fields(data):
+            if field == 1:
+                self.strings = [pbf_string(data[a:b]) for f, (a, b) in pbf_fields(data, *value) if f == 1]
+            elif field == 2:
+                self.groups.append(value)
+            elif field == 17:
+                self.granularity = value
+            elif field == 18:
+                self.date_granularity = value
+            elif field == 19:
+                self.lat_offset = signed(value)
+            elif field == 20:
+                self.lon_offset = signed(value)
+
+    def records(self, tags=('node', 'way', 'relation')):
+        records = []
+        for span in self.groups:
+            for field, value in pbf_fields(self.data, *span):
+                if field == 2 and 'node' in tags:
+                    records.extend(self.dense_nodes(value))
+                elif field == 1 and 'node' in tags:
+                    records.append(self.node(value))
+                elif field == 3 and 'way' in tags:
+                    records.append(self.way(value))
+                elif field == 4 and 'relation' in tags:
+                    records.append(self.relation(value))
+        return records
+
+    def coordinates(self, values, offset):
+        '''Text for raw lat or lon values as in the XML: 7 decimals, trailing zeros dropped'''
+        units = (offset + self.granularity * np.asarray(values, dtype=np.int64) + 50) // 100
+        whole, fraction = np.divmod(np.abs(units), 10 ** 7)
+        signs = np.where(units < 0, '-', '').tolist()
+        return [('%s%d.%07d' % text).rstrip('0').rstrip('.')
+                for text in zip(signs, whole.tolist(), fraction.tolist())]
+
+    def timestamp(self, value):
+        return format_timestamp(value * self.date_granularity // 1000)
+
+    def add_info(self, attrib, version, timestamp, changeset, uid, user_sid):
+        attrib['version'] = str(version)
+        attrib['timestamp'] = self.timestamp(timestamp)
+        attrib['changeset'] = str(changeset)
+        user = self.strings[user_sid]
+        if user:  # anonymous edits have no user or uid in the XML either
+            attrib['uid'] = str(uid)
+            attrib['user'] = user
+
+    def info(self, span, attrib):
+        fields = dict((field, value) for field, value in pbf_fields(self.data, *span))
+        self.add_info(attrib, fields.get(1, -1), signed(fields.get(2, 0)), signed(fields.get(3, 0)),
+                      signed(fields.get(4, 0)), fields.get(5, 0))
+
+    def tags(self, keys, values):
+        strings = self.strings
+        return [('tag', {'k': strings[k], 'v': strings[v]}) for k, v in zip(keys, values)]
+
+    def dense_nodes(self, span):
+        data = self.data
+        ids = lats = lons = keys_vals = None
+        info = {}
+        for field, value in pbf_fields(data, *span):
+            if field == 1:
+                ids = packed_array(data, value, zigzag_coded=True, delta=True)
+            elif field == 5:
+                for info_field, info_value in pbf_fields(data, *value):
+                    if info_field == 1:
+                        info[1] = packed_array(data, info_value).tolist()
+                    elif info_field in (2, 3, 4, 5):
+                        info[info_field] = packed_array(data, info_value, zigzag_coded=True, delta=True).tolist()
+            elif field == 8:
+                lats = packed_array(data, value, zigzag_coded=True, delta=True)
+            elif field == 9:
+                lons = packed_array(data, value, zigzag_coded=True, delta=True)
+            elif field == 10:
+                keys_vals = packed_array(data, value).tolist()
+        if ids is None:
+            return []
+        lats = self.coordinates(lats, self.lat_offset)
+        lons = self.coordinates(lons, self.lon_offset)
+        strings = self.strings
+        records = []
+        kv = 0
+        for i, id_ in enumerate(ids.tolist()):
+            attrib = {'id': str(id_), 'lat': lats[i], 'lon': lons[i]}
+            if info:
+                self.add_info(attrib, info[1][i], info[2][i], info[3][i], info[4][i], info[5][i])
+            children = []
+            if keys_vals:
+                while keys_vals[kv]:
+                    children.append(('tag', {'k': strings[keys_vals[kv]], 'v': strings[keys_vals[kv + 1]]}))
+                    kv += 2
+                kv += 1
+            records.append(('node', attrib, children))
+        return records
+
+    def node(self, span):
+        attrib, keys, values, lat, lon = {}, [], [], 0, 0
+        for field, value in pbf_fields(self.data, *span):
+            if field == 1:
+                attrib['id'] = str(zigzag(value))
+            elif field == 2:
+                keys = packed_varints(self.data, value)
+            elif field == 3:
+                values = packed_varints(self.data, value)
+            elif field == 4:
+                self.info(value, attrib)
+            elif field == 8:
+                lat = zigzag(value)
+            elif field == 9:
+                lon = zigzag(value)
+        attrib['lat'] = self.coordinates([lat], self.lat_offset)[0]
+        attrib['lon'] = self.coordinates([lon], self.lon_offset)[0]
+        return ('node', attrib, self.tags(keys, values))
+
+    def way(self, span):
+        attrib, keys, values, refs = {}, [], [], []
+        for field, value in pbf_fields(self.data, *span):
+            if field == 1:
+                attrib['id'] = str(value)
+            elif field == 2:
+                keys = packed_varints(self.data, value)
+            elif field == 3:
+                values = packed_varints(self.data, value)
+            elif field == 4:
+                self.info(value, attrib)
+            elif field == 8:
+                refs = delta_decode(packed_varints(self.data, value))
+        return ('way', attrib, [('nd', {'ref': str(ref)}) for ref in refs] + self.tags(keys, values))
+
+    def relation(self, span):
+        attrib, keys, values, roles, ids, types = {}, [], [], [], [], []
+        for field, value in pbf_fields(self.data, *span):
+            if field == 1:
+                attrib['id'] = str(value)
+            elif field == 2:
+                keys = packed_varints(self.data, value)
+            elif field == 3:
+                values = packed_varints(self.data, value)
+            elif field == 4:
+                self.info(value, attrib)
+            elif field == 8:
+                roles = packed_varints(self.data, value)
+            elif field == 9:
+                ids = delta_decode(packed_varints(self.data, value))
+            elif field == 10:
+                types = packed_varints(self.data, value)
+        members = [('member', {'type': PBF_MEMBER_TYPES[type_], 'ref': str(ref), 'role': self.strings[role]})
+                   for role, ref, type_ in zip(roles, ids, types)]
+        return ('relation', attrib, members + self.tags(keys, values))
+
+
+def read_blob(path, offset, size):
+    '''The uncompressed contents of the Blob message at offset in path, as a bytearray'''
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        blob = bytearray(f.read(size))
+    if len(blob) != size:
+        raise IOError('{} ends in the middle of a blob'.format(path))
+    for field, value in pbf_fields(blob):
+        if field == 1:
+            return blob[value[0]:value[1]]
+        if field == 3:
+            return bytearray(zlib.decompress(buffer(blob, value[0], value[1] - value[0])))
+        if field != 2:  # 2 is the raw size
+            raise ValueError('{}: unsupported blob compression (Blob field {})'.format(path, field))
+    return bytearray()
+
+
+def pbf_blobs(path):
+    '''Yield (type, offset, size) of every blob in a PBF file, reading only the BlobHeaders'''
+    with open(path, 'rb') as f:
+        while True:
+            head = f.read(4)
+            if not head:
+                return
+            header = bytearray(f.read(struct.unpack('>I', head)[0]))
+            blob_type, size = None, 0
+            for field, value in pbf_fields(header):
+                if field == 1:
+                    blob_type = str(header[value[0]:value[1]])
+                elif field == 3:
+                    size = value
+            offset = f.tell()
+            yield blob_type, offset, size
+            f.seek(offset + size)
+
+
+def pbf_jobs(path, tags):
+    '''One decode_pbf_blob job per OSMData blob, after checking the OSMHeader blob's required features'''
+    for blob_type, offset, size in pbf_blobs(path):
+        if blob_type == 'OSMHeader':
+            header = read_blob(path, offset, size)
+            for field, value in pbf_fields(header):
+                if field == 4 and str(header[value[0]:value[1]]) not in PBF_FEATURES:
+                    raise ValueError('{} needs {}, which pbf_elements can\'t read'.format(
+                                     path, str(header[value[0]:value[1]])))
+        elif blob_type == 'OSMData':
+            yield path, offset, size, tags
+
+
+def decode_pbf_blob(job):
+    '''Pool worker: read and decode one OSMData blob'''
+    path, offset, size, tags = job
+    return PrimitiveBlockDecoder(read_blob(path, offset, size)).records(tags)
+
+
+def pbf_elements(osm_file, tags=('node', 'way', 'relation'), workers=None):
+    '''Yield an OSMRecord for every element in tags from a .osm.pbf file, in file order'''
+    workers = PBF_WORKERS if workers is None else workers
+    jobs = pbf_jobs(osm_file, tags)
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        if pool is None:
+            blocks = itertools.imap(decode_pbf_blob, jobs)
+        else:
+            blocks = (records for _, records in bounded_imap(pool, decode_pbf_blob, jobs, 2 * workers))
+        for records in blocks:
+            for tag, attrib, children in records:
+                yield OSMRecord(tag, attrib, [OSMRecord(child, child_attrib) for child, child_attrib in children])
+                if memory_probe.enabled:
+                    memory_probe.count(len(records))
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def benchmark_pbf(xml_file, pbf_file, workers=(1, 4), repeat=3):
+    '''Elements/sec of get_element on an XML file (with each backend) and on the same data as .osm.pbf'''
+    runs = [('xml ' + name, xml_file, {'backend': name}) for name in sorted(PARSER_BACKENDS)]
+    runs += [('pbf, {} worker(s)'.format(n), pbf_file, {'workers': n}) for n in workers]
+    results = {}
+    for name, path, options in runs:
+        counts = []
+
+        def run():
+            del counts[:]
+            elements = (pbf_elements(path, workers=options['workers']) if 'workers' in options
+                        else get_element(path, backend=options['backend']))
+            for element in elements:
+                shape_rows(element)
+                counts.append(1)
+
+        seconds = min(timeit.repeat(run, number=1, repeat=repeat))
+        results[name] = len(counts) / seconds
+        print '{:20} {:8.1f} MB  {:,.0f} elements/sec'.format(name, os.path.getsize(path) / 1048576.0,
+                                                              results[name])
+    return results
+
+#benchmark_pbf(in_file, 'seattle_washington.osm.pbf', workers=(1, multiprocessing.cpu_count()))
+
+
+
+# patterns used by split_tag_key, compiled once here instead of on every call
+TAG_TYPE = re.compile(r'^([a-z]+):') #pattern to find ahead of :
+TAG_KEY = re.compile(r'^[a-z]+:([a-z]+:?[a-z]+.?[a-z]*)') #pattern to find after :
+TAG_PROBLEMCHARS = re.compile(r'([=\+\/&<>;\'"\?%#$@\,\. \t\r\n])')
+
+
+def split_tag_key(key):
+    '''Split a tag key like addr:street into (type, key), or (None, None) if it has problem characters'''
+    if TAG_PROBLEMCHARS.search(key):
+        return None, None
+    m = TAG_TYPE.search(key)
+    l = TAG_KEY.search(key)
+    if l:
+        return m.group(1), l.group(1)
+    return None, key
+
+
+def parse_type_attrib(elem):
+    return split_tag_key(elem.attrib['k'])
+
+
+def intern_string(s):
+    '''intern() s if it's a byte string, Python 2 can't intern unicode so those are returned as they are'''
+    try:
+        return intern(s)
+    except TypeError:
+        return s
+
+
+class TagKeyClassifier(object):
+    """Lookup table of tag key -> (type, key) used by shape_element
+
+    There are only a few thousand distinct keys among millions of tags, so each
+    key is split with split_tag_key the first time it is seen and every later
+    tag with that key gets the same tuple of interned strings back. The type is
+    already 'regular' for keys without one, keys with problem characters map to None.
+    """
+
+    def __init__(self):
+        self.table = {}
+
+    def classify(self, k):
+        try:
+            return self.table[k]
+        except KeyError:
+            t, key = split_tag_key(k)
+            split = (intern_string(t or 'regular'), intern_string(key)) if key is not None else None
+            self.table[intern_string(k)] = split
+            return split
+
+    def stats(self):
+        splits = [split for split in self.table.values() if split]
+        return {'keys': len(self.table), 'dropped': len(self.table) - len(splits),
+                'types': len(set(t for t, _ in splits))}
+
+    def report(self):
+        print 'tag keys: {keys} distinct, {dropped} dropped for problem characters, {types} types'.format(
+            **self.stats())
+
+tag_keys = TagKeyClassifier()
+
+
+# The tag clean up used to be a pandas pass over the finished csv files (and the indian cuisine fix
+# came after the csv files were saved, so it never made it into them).  The same fixes are now data:
+# every rule is (action, match, argument), where match looks at any of the key, type and value of a
+# tag (key and type as split by split_tag_key) and the action is
+#   drop   - leave the tag out
+#   rename - change the key to argument
+#   remap  - change the value to argument (match has to include a value)
+# TagRuleEngine applies them inside shape_rows, so the tags are clean the first time they are written.
+
+# In[ ]:
+
+TAG_RULES = [('drop', {'key': 'fixme'}, None),
+             ('drop', {'type': 'not'}, None),
+             ('drop', {'type': 'removed'}, None),
+             ('remap', {'value': 'centre'}, 'center'),
+             ('remap', {'key': 'cuisine', 'value': 'Nepalese,_Indian,_Tibetan'}, 'indian'),
+             ('remap', {'key': 'cuisine', 'value': 'Indian,_South_East_Asian'}, 'indian')]
+
+RULE_ACTIONS = ('drop', 'rename', 'remap')
+RULE_FIELDS = frozenset(['key', 'type', 'value'])
+
+
+class TagRuleEngine(object):
+    """Compiled TAG_RULES: apply(k, v) gives the (key, value, type, norm) of a tag after the rules, or None
+
+    Rules are applied in order.  The ones that only look at the key and type
+    are worked out once per distinct raw key, together with the key split from
+    classifier.  The ones that look at the value are grouped by that value, so
+    a tag whose value no rule mentions only costs one more dict lookup.  norm
+    is the value run through taxonomies[key] for regular tags, otherwise None.
+    """
+
+    def __init__(self, rules, classifier, taxonomies=None):
+        self.classifier = classifier
+        self.taxonomies = taxonomies or {}
+        self.key_rules = []
+        self.value_rules = defaultdict(list)
+        for action, match, argument in rules:
+            if action not in RULE_ACTIONS:
+                raise ValueError('unknown tag rule action %r' % (action,))
+            if not match or set(match) - RULE_FIELDS:
+                raise ValueError('tag rule match needs some of %s, got %r' % (sorted(RULE_FIELDS), match))
+            if action == 'remap' and 'value' not in match:
+                raise ValueError('remap rules have to match a value: %r' % (match,))
+            rule = (action, match.get('key'), match.get('type'), argument)
+            if 'value' in match:
+                self.value_rules[match['value']].append(rule)
+            else:
+                self.key_rules.append(rule)
+        self.table = {}
+
+    def split(self, k):
+        '''(key, type, normalizer) of raw key k after the key and type rules, or None if the tag is dropped'''
+        split = self.classifier.classify(k)
+        if split:
+            type_, key = split
+            for action, m_key, m_type, argument in self.key_rules:
+                if (m_key is None or m_key == key) and (m_type is None or m_type == type_):
+                    if action == 'drop':
+                        split = None
+                        break
+                    key = intern_string(argument)
+            else:
+                split = (key, type_, self.normalizer(key, type_))
+        self.table[k] = split
+        return split
+
+    def normalizer(self, key, type_):
+        return self.taxonomies.get(key) if type_ == 'regular' else None
+
+    def apply(self, k, v):
+        try:
+            split = self.table[k]
+        except KeyError:
+            split = self.split(k)
+        if split is None:
+            return None
+        key, type_, normalizer = split
+        if v in self.value_rules:
+            for action, m_key, m_type, argument in self.value_rules[v]:
+                if (m_key is None or m_key == key) and (m_type is None or m_type == type_):
+                    if action == 'drop':
+                        return None
+                    if action == 'rename':
+                        key = argument
+                        normalizer = self.normalizer(key, type_)
+                    else:
+                        v = argument
+        return (key, v, type_, normalizer.normalize(v) if normalizer is not None else None)
+
+
+# cuisine, shop and amenity are free text in practice: 'Nepalese,_Indian,_Tibetan', 'Burgers',
+# 'bbq;Tex_Mex'...  TaxonomyNormalizer turns a raw value into a sorted, ';' separated list of terms
+# from a canonical vocabulary.  The value is split on ';' and ',', each part is case folded and
+# looked up whole (so coffee_shop stays one term), then fuzzy matched, then split on '_' if all of
+# the pieces are known terms.  Anything left over is kept as it is, case folded.  Each distinct raw
+# value is only worked out once.  The result goes in the 'norm' column of the tag tables, which is
+# indexed with the key, e.g. WHERE key = 'cuisine' AND norm = 'indian'.
+
+# In[ ]:
+
+CUISINE_VOCABULARY = ['african', 'american', 'asian', 'bagel', 'barbecue', 'breakfast', 'bubble_tea',
+                      'burger', 'cajun', 'caribbean', 'chicken', 'chinese', 'coffee_shop', 'crepe',
+                      'deli', 'dessert', 'donut', 'ethiopian', 'filipino', 'fish_and_chips', 'french',
+                      'frozen_yogurt', 'german', 'greek', 'hawaiian', 'hot_dog', 'ice_cream', 'indian',
+                      'indonesian', 'international', 'italian', 'japanese', 'juice', 'korean',
+                      'latin_american', 'lebanese', 'malaysian', 'mediterranean', 'mexican',
+                      'middle_eastern', 'moroccan', 'nepalese', 'noodle', 'pakistani', 'peruvian', 'pizza',
+                      'ramen', 'regional', 'salad', 'sandwich', 'seafood', 'soup', 'spanish', 'steak_house',
+                      'sushi', 'tapas', 'tea', 'teriyaki', 'tex-mex', 'thai', 'tibetan', 'turkish', 'vegan',
+                      'vegetarian', 'vietnamese', 'wings']
+CUISINE_ALIASES = {'bbq': 'barbecue', 'coffee': 'coffee_shop', 'espresso': 'coffee_shop',
+                   'doughnut': 'donut', 'steak': 'steak_house', 'steakhouse': 'steak_house',
+                   'south_east_asian': 'asian', 'southeast_asian': 'asian', 'pho': 'vietnamese',
+                   'tex_mex': 'tex-mex', 'yogurt': 'frozen_yogurt', 'hamburger': 'burger'}
+
+SHOP_VOCABULARY = ['alcohol', 'bakery', 'beauty', 'bicycle', 'books', 'butcher', 'car', 'car_parts',
+                   'car_repair', 'clothes', 'computer', 'convenience', 'cosmetics', 'department_store',
+                   'doityourself', 'dry_cleaning', 'electronics', 'florist', 'furniture', 'garden_centre',
+                   'gift', 'hairdresser', 'hardware', 'jewelry', 'laundry', 'mall', 'mobile_phone', 'music',
+                   'optician', 'outdoor', 'pet', 'shoes', 'sports', 'stationery', 'supermarket', 'tattoo',
+                   'tobacco', 'toys', 'travel_agency', 'variety_store', 'wine']
+SHOP_ALIASES = {'bike': 'bicycle', 'grocery': 'supermarket', 'hair': 'hairdresser', 'jewellery': 'jewelry',
+                'liquor': 'alcohol', 'garden_center': 'garden_centre', 'diy': 'doityourself'}
+
+AMENITY_VOCABULARY = ['atm', 'bank', 'bar', 'bbq', 'bench', 'bicycle_parking', 'bicycle_rental', 'bus_station',
+                      'cafe', 'car_sharing', 'charging_station', 'cinema', 'clinic', 'college',
+                      'community_centre', 'dentist', 'doctors', 'drinking_water', 'fast_food', 'fire_station',
+                      'fountain', 'fuel', 'hospital', 'ice_cream', 'kindergarten', 'library', 'marketplace',
+                      'parking', 'parking_entrance', 'pharmacy', 'place_of_worship', 'police', 'post_box',
+                      'post_office', 'pub', 'recycling', 'restaurant', 'school', 'shelter', 'social_facility',
+                      'theatre', 'toilets', 'townhall', 'university', 'vending_machine', 'veterinary',
+                      'waste_basket']
+AMENITY_ALIASES = {'community_center': 'community_centre', 'theater': 'theatre', 'gas': 'fuel',
+                   'gas_station': 'fuel', 'doctor': 'doctors', 'toilet': 'toilets'}
+
+TAXONOMY_SPLIT = re.compile(r'[;,]')
+FUZZY_CUTOFF = 0.85
+
+
+class TaxonomyNormalizer(object):
+    """Map raw values of one multi-valued tag onto a canonical vocabulary, caching every distinct value"""
+
+    def __init__(self, vocabulary, aliases=None, cutoff=FUZZY_CUTOFF):
+        self.vocabulary = sorted(set(vocabulary))
+        self.terms = dict((term, term) for term in self.vocabulary)
+        for alias, term in (aliases or {}).items():
+            if term not in self.terms:
+                raise ValueError('alias %r points at %r, which is not in the vocabulary' % (alias, term))
+            self.terms[alias] = term
+        self.cutoff = cutoff
+        self.cache = {}
+        self.fuzzy = 0
+        self.unknown = 0
+
+    def term(self, part):
+        '''Canonical term(s) for one part of a value'''
+        if part in self.terms:
+            return [self.terms[part]]
+        close = difflib.get_close_matches(part, self.terms, 1, self.cutoff) if len(part) > 3 else []
+        if close:
+            self.fuzzy += 1
+            return [self.terms[close[0]]]
+        pieces = [piece for piece in part.split('_') if piece]
+        if len(pieces) > 1 and all(piece in self.terms for piece in pieces):
+            return [self.terms[piece] for piece in pieces]
+        self.unknown += 1
+        return [part]
+
+    def normalize(self, value):
+        '''Sorted ';' separated canonical terms for a raw value, or None if it has none'''
+        try:
+            return self.cache[value]
+        except KeyError:
+            pass
+        terms = set()
+        for part in TAXONOMY_SPLIT.split(value.lower()):
+            part = '_'.join(part.replace('_', ' ').split())
+            if part:
+                terms.update(self.term(part))
+        norm = ';'.join(sorted(terms)) or None
+        self.cache[value] = norm
+        return norm
+
+    def stats(self):
+        return {'values': len(self.cache), 'fuzzy': self.fuzzy, 'unknown': self.unknown}
+
+# tag key -> normalizer for the 'norm' column
+TAXONOMIES = {'cuisine': TaxonomyNormalizer(CUISINE_VOCABULARY, CUISINE_ALIASES),
+              'shop': TaxonomyNormalizer(SHOP_VOCABULARY, SHOP_ALIASES),
+              'amenity': TaxonomyNormalizer(AMENITY_VOCABULARY, AMENITY_ALIASES)}
+
+tag_rules = TagRuleEngine(TAG_RULES, tag_keys, TAXONOMIES)
             
 
 
-def process_map(file_in): ## ADD RELATIONS
-    """Iteratively process each XML element and write to csv(s)"""
+# The Yakima ways and the nodes out at longitude -123.9 only showed up once everything was in sqlite.
+# clip_elements() sits between get_element and the shaping and drops them before anything is written.
+# Nodes are tested against a ClipArea (a bbox or a polygon) a batch at a time with numpy; ways are kept
+# if any of their nodes was kept, and relations if any member node, way or earlier relation was kept.
+# Elements come out in the same order they went in.
+
+# In[ ]:
+
+CLIP_BATCH = 10000
+
+# rough outline of King County, (lat, lon) corners
+KING_COUNTY = [(47.78, -122.54), (47.78, -121.07), (47.26, -121.07), (47.08, -121.45),
+               (47.08, -122.14), (47.26, -122.34), (47.26, -122.54)]
+
+
+class ClipArea(object):
+    """Area that clip_elements keeps: a polygon of (lat, lon) corners or a (min_lat, min_lon, max_lat, max_lon) bbox"""
+
+    def __init__(self, polygon=None, bbox=None):
+        if (polygon is None) == (bbox is None):
+            raise ValueError('give exactly one of polygon and bbox')
+        if polygon is not None:
+            self.polygon = np.array(polygon, dtype=float)
+            if self.polygon.ndim != 2 or self.polygon.shape[1] != 2 or len(self.polygon) < 3:
+                raise ValueError('polygon needs at least 3 (lat, lon) corners')
+            lats, lons = self.polygon[:, 0], self.polygon[:, 1]
+            self.bbox = (lats.min(), lons.min(), lats.max(), lons.max())
+        else:
+            self.polygon = None
+            self.bbox = tuple(bbox)
+
+    def contains(self, lat, lon):
+        '''Boolean array: which of the points in the lat and lon arrays are inside'''
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        inside = (lat >= min_lat) & (lat <= max_lat) & (lon >= min_lon) & (lon <= max_lon)
+        if self.polygon is None or not inside.any():
+            return inside
+        # even-odd ray casting, one polygon edge at a time over all points still in the bbox
+        candidates = np.flatnonzero(inside)
+        y, x = lat[candidates], lon[candidates]
+        odd = np.zeros(len(candidates), dtype=bool)
+        y2, x2 = self.polygon[-1]
+        for y1, x1 in self.polygon:
+            if y1 != y2:
+                crosses = (y1 > y) != (y2 > y)
+                odd ^= crosses & (x < x1 + (y - y1) * (x2 - x1) / (y2 - y1))
+            y2, x2 = y1, x1
+        inside[candidates] = odd
+        return inside
+
+
+class IdSet(object):
+    """Growing set of int64 ids with vectorized membership tests"""
+
+    def __init__(self):
+        self.chunks = []
+        self.ids = np.zeros(0, dtype=np.int64)
+
+    def add(self, ids):
+        if len(ids):
+            self.chunks.append(np.asarray(ids, dtype=np.int64))
+
+    def contains(self, ids):
+        if self.chunks:
+            self.ids = np.unique(np.concatenate([self.ids] + self.chunks))
+            self.chunks = []
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(self.ids):
+            return np.zeros(len(ids), dtype=bool)
+        pos = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        return self.ids[pos] == ids
+
+    def __len__(self):
+        self.contains([])
+        return len(self.ids)
+
+
+def any_by_element(hits, counts):
+    '''hits holds one flag per ref for a run of elements with counts refs each; True where any ref hit'''
+    totals = np.concatenate(([0], np.cumsum(hits, dtype=np.int64)))
+    ends = np.cumsum(counts)
+    return totals[ends] - totals[ends - counts] > 0
+
+
+class Clipper(object):
+    """Keeps track of which nodes, ways and relations clip_elements let through"""
+
+    def __init__(self, area):
+        self.area = area
+        self.kept = {'node': IdSet(), 'way': IdSet(), 'relation': IdSet()}
+        self.tests = {'node': self.keep_nodes, 'way': self.keep_ways, 'relation': self.keep_relations}
+        self.dropped = defaultdict(int)
+
+    def keep_nodes(self, batch):
+        ids, lat, lon = [], [], []
+        for elem in batch:
+            ids.append(int(elem.attrib['id']))
+            # nodes without coordinates are treated as outside
+            lat.append(float(elem.attrib.get('lat', 'nan')))
+            lon.append(float(elem.attrib.get('lon', 'nan')))
+        return np.asarray(ids, dtype=np.int64), self.area.contains(np.array(lat), np.array(lon))
+
+    def keep_ways(self, batch):
+        ids, refs, counts = [], [], []
+        for elem in batch:
+            ids.append(int(elem.attrib['id']))
+            nds = [int(nd.attrib['ref']) for nd in elem.findall('nd')]
+            refs.extend(nds)
+            counts.append(len(nds))
+        hits = self.kept['node'].contains(refs)
+        return np.asarray(ids, dtype=np.int64), any_by_element(hits, np.array(counts, dtype=np.int64))
+
+    def keep_relations(self, batch):
+        ids, counts = [], []
+        refs = {'node': [], 'way': [], 'relation': []}
+        member_types = []
+        for elem in batch:
+            ids.append(int(elem.attrib['id']))
+            members = [m for m in elem.findall('member') if m.attrib['type'] in refs]
+            for m in members:
+                refs[m.attrib['type']].append(int(m.attrib['ref']))
+                member_types.append(m.attrib['type'])
+            counts.append(len(members))
+        member_types = np.array(member_types)
+        counts = np.array(counts, dtype=np.int64)
+        ids = np.asarray(ids, dtype=np.int64)
+        hits = np.zeros(len(member_types), dtype=bool)
+        for kind, kind_refs in refs.items():
+            if kind_refs:
+                hits[member_types == kind] = self.kept[kind].contains(kind_refs)
+        keep = any_by_element(hits, counts)
+        if not refs['relation']:
+            return ids, keep
+        # a relation member only counts if it comes earlier in the file: the relations kept from
+        # earlier batches are in hits already, and the ones earlier in this batch are added until
+        # keep stops changing, so that chains of relations come out the same for any batch size
+        relation_members = member_types == 'relation'
+        member_refs = np.asarray(refs['relation'], dtype=np.int64)
+        owner = np.repeat(np.arange(len(ids)), counts)[relation_members]
+        order = np.argsort(ids, kind='mergesort')
+        pos = order[np.minimum(np.searchsorted(ids[order], member_refs), len(ids) - 1)]
+        earlier = (ids[pos] == member_refs) & (pos < owner)
+        kept_before = hits[relation_members]
+        while True:
+            hits[relation_members] = kept_before | (earlier & keep[pos])
+            grown = any_by_element(hits, counts)
+            if (grown == keep).all():
+                return ids, keep
+            keep = grown
+
+    def filter(self, batch):
+        '''Return the elements of batch (all of one type) that are kept'''
+        tag = batch[0].tag
+        ids, keep = self.tests[tag](batch)
+        self.kept[tag].add(ids[keep])
+        self.dropped[tag] += len(batch) - int(keep.sum())
+        return [elem for elem, k in zip(batch, keep) if k]
+
+    def report(self):
+        print 'clipped: {} nodes, {} ways, {} relations dropped'.format(
+            self.dropped['node'], self.dropped['way'], self.dropped['relation'])
+
+
+def clip_elements(elements, clipper, batch_size=CLIP_BATCH):
+    '''Yield the elements that clipper keeps, in the same order, testing batch_size of them at a time'''
+    batch = []
+    for elem in elements:
+        if batch and (elem.tag != batch[0].tag or len(batch) >= batch_size):
+            for kept in clipper.filter(batch):
+                yield kept
+            batch = []
+        batch.append(elem)
+    if batch:
+        for kept in clipper.filter(batch):
+            yield kept
+
+
+def check_clip_batches(file_in, area, batch_sizes=(7, CLIP_BATCH)):
+    '''Clip file_in with each of batch_sizes and return True if they all keep the same elements'''
+    kept = []
+    for batch_size in batch_sizes:
+        kept.append([(elem.tag, elem.attrib['id']) for elem in
+                     clip_elements(get_element(file_in), Clipper(area), batch_size)])
+        print '{:6} {:,} elements kept'.format(batch_size, len(kept[-1]))
+    return all(ids == kept[0] for ids in kept[1:])
+
+#check_clip_batches(in_file, ClipArea(KING_COUNTY))
+
+
+
+# Way geometry needs the coordinates of every node a way uses: 8M ways_nodes refs against 7.2M nodes,
+# which is a huge join in sqlite or pandas and gigabytes as a Python dict.  NodeStore keeps the nodes
+# in three numpy arrays instead (sorted int64 ids and int32 fixed point or float32 lat/lon, 16 or 12
+# bytes a node), optionally as memory mapped .npy files, and looks up any number of ids in one
+# searchsorted call.  GeometryCollector fills one in while process_map parses the file and then
+# works out the length, bounding box and (for closed ways) area of every way in one vectorized pass.
 
-    with codecs.open(NODES_PATH, 'w') as nodes_file,         codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file,         codecs.open(WAYS_PATH, 'w') as ways_file,         codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file,         codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file,         codecs.open(REL_TAGS_PATH, 'w') as rel_tags_file,         codecs.open(REL_MEMBERS_PATH, 'w') as rel_members_file,         codecs.open(RELS_PATH, 'w') as rel_file:
+# In[ ]:
 
-        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
-        rel_tags_writer = UnicodeDictWriter(rel_tags_file, REL_TAGS_FIELDS)
-        rel_members_writer = UnicodeDictWriter(rel_members_file, REL_MEMBERS_FIELDS)
-        rels_writer = UnicodeDictWriter(rel_file, REL_FIELDS)
+COORD_SCALE = 10 ** 7  # OSM coordinates have 7 decimals, so int32 fixed point is exact
+EARTH_RADIUS = 6371008.8  # metres
+ARRAY_CHUNK = 1000000
 
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
-        rel_tags_writer.writeheader()
-        rel_members_writer.writeheader()
-        rels_writer.writeheader()
+WAY_GEOMETRY_PATH = 'ways_geometry.csv'
+WAY_GEOMETRY_FIELDS = ['id', 'nodes', 'missing', 'length', 'min_lat', 'min_lon', 'max_lat', 'max_lon',
+                       'closed', 'area']
 
-        for element in get_element(file_in, tags=('node', 'way', 'relation')):
-            el = shape_element(element)
-            if el:
-                if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
-                elif element.tag == 'relation':
-                    rels_writer.writerow(el['relation'])
-                    rel_members_writer.writerows(el['rel_members'])
-                    rel_tags_writer.writerows(el['rel_tags'])
+
+class ArrayBuilder(object):
+    """Append values one at a time into a numpy array of dtype, a list of ARRAY_CHUNK values at a time
+
+    With scale, values are stored as round(value * scale).
+    """
+
+    def __init__(self, dtype, scale=None):
+        self.dtype = dtype
+        self.scale = scale
+        self.values = []
+        self.chunks = []
+
+    def append(self, value):
+        self.values.append(value)
+        if len(self.values) >= ARRAY_CHUNK:
+            self.flush()
+
+    def extend(self, values):
+        self.values.extend(values)
+        if len(self.values) >= ARRAY_CHUNK:
+            self.flush()
+
+    def flush(self):
+        if self.values:
+            values = np.array(self.values, dtype=np.float64 if self.scale else self.dtype)
+            if self.scale:
+                values = np.round(values * self.scale)
+            self.chunks.append(values.astype(self.dtype))
+            self.values = []
+
+    def array(self):
+        self.flush()
+        return np.concatenate(self.chunks) if self.chunks else np.zeros(0, dtype=self.dtype)
+
+    def __len__(self):
+        return sum(len(chunk) for chunk in self.chunks) + len(self.values)
+
+
+class NodeStore(object):
+    """Node id -> (lat, lon) backed by sorted numpy arrays
+
+    add() nodes in any order, then finish() sorts them (and saves them to
+    path_ids.npy, path_lat.npy and path_lon.npy if path is given, reopening
+    them memory mapped).  NodeStore.load(path) opens saved arrays again.
+    """
+
+    def __init__(self, path=None, fixed_point=True):
+        self.path = path
+        self.fixed_point = fixed_point
+        coords = (np.int32, COORD_SCALE) if fixed_point else (np.float32, None)
+        self.new_ids = ArrayBuilder(np.int64)
+        self.new_lat = ArrayBuilder(*coords)
+        self.new_lon = ArrayBuilder(*coords)
+        self.ids = None
+
+    def add(self, id_, lat, lon):
+        self.new_ids.append(id_)
+        self.new_lat.append(lat)
+        self.new_lon.append(lon)
+
+    def finish(self):
+        ids, lat, lon = self.new_ids.array(), self.new_lat.array(), self.new_lon.array()
+        if len(ids) and (np.diff(ids) < 0).any():
+            order = np.argsort(ids, kind='mergesort')
+            ids, lat, lon = ids[order], lat[order], lon[order]
+        if self.path:
+            for name, values in (('ids', ids), ('lat', lat), ('lon', lon)):
+                np.save('{}_{}.npy'.format(self.path, name), values)
+            self.ids, self.lat, self.lon = self.open_arrays(self.path)
+        else:
+            self.ids, self.lat, self.lon = ids, lat, lon
+        self.new_ids.chunks = self.new_lat.chunks = self.new_lon.chunks = []
+        return self
+
+    @staticmethod
+    def open_arrays(path):
+        return [np.load('{}_{}.npy'.format(path, name), mmap_mode='r') for name in ('ids', 'lat', 'lon')]
+
+    @classmethod
+    def load(cls, path):
+        store = cls(path)
+        store.ids, store.lat, store.lon = cls.open_arrays(path)
+        store.fixed_point = store.lat.dtype == np.int32
+        return store
+
+    def lookup(self, ids):
+        '''Return lat, lon (float64, nan where missing) and a found mask for an array of ids'''
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(self.ids):
+            nan = np.full(len(ids), np.nan)
+            return nan, nan.copy(), np.zeros(len(ids), dtype=bool)
+        pos = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        found = self.ids[pos] == ids
+        lat = self.lat[pos].astype(np.float64)
+        lon = self.lon[pos].astype(np.float64)
+        if self.fixed_point:
+            lat /= COORD_SCALE
+            lon /= COORD_SCALE
+        lat[~found] = np.nan
+        lon[~found] = np.nan
+        return lat, lon, found
+
+    def __len__(self):
+        return len(self.ids) if self.ids is not None else len(self.new_ids)
+
+
+def distances(lat1, lon1, lat2, lon2):
+    '''Great circle distance in metres (haversine) between arrays of points'''
+    phi1, phi2 = np.radians(lat1), np.radians(lat2)
+    a = (np.sin((phi2 - phi1) / 2) ** 2 +
+         np.cos(phi1) * np.cos(phi2) * np.sin(np.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def way_geometry(store, way_ids, refs, counts):
+    '''Length (m), bbox and area (m2, closed ways only) of every way, as a dict of WAY_GEOMETRY_FIELDS arrays
+
+    refs holds the node refs of all of the ways one after the other and
+    counts the number of refs of each way.  Ways with a node that is not in
+    store get nan for everything but their bbox, which covers the nodes found.
+    '''
+    counts = np.asarray(counts, dtype=np.int64)
+    refs = np.asarray(refs, dtype=np.int64)
+    n_ways = len(counts)
+    way = np.repeat(np.arange(n_ways), counts)  # way index of every ref
+    lat, lon, found = store.lookup(refs)
+    missing = np.bincount(way[~found], minlength=n_ways)
+
+    # segments between consecutive refs of the same way
+    same = way[:-1] == way[1:]
+    seg_way = way[:-1][same]
+    seg_len = distances(lat[:-1][same], lon[:-1][same], lat[1:][same], lon[1:][same])
+    length = np.bincount(seg_way, weights=np.nan_to_num(seg_len), minlength=n_ways)
+
+    bbox = []
+    starts = np.cumsum(counts) - counts
+    nonempty = counts > 0
+    for values in (lat, lon):
+        for reduce in (np.fmin, np.fmax):
+            result = np.full(n_ways, np.nan)
+            if nonempty.any():
+                result[nonempty] = reduce.reduceat(values, starts[nonempty])
+            bbox.append(result)
+    min_lat, max_lat, min_lon, max_lon = bbox
+
+    closed = np.zeros(n_ways, dtype=bool)
+    ring = counts >= 4
+    closed[ring] = refs[starts[ring]] == refs[starts[ring] + counts[ring] - 1]
+    # shoelace formula on an equirectangular projection centred on each way
+    scale = np.cos(np.radians((min_lat + max_lat) / 2))[seg_way]
+    x1 = np.radians(lon[:-1][same]) * scale
+    x2 = np.radians(lon[1:][same]) * scale
+    y1, y2 = np.radians(lat[:-1][same]), np.radians(lat[1:][same])
+    twice_area = np.bincount(seg_way, weights=np.nan_to_num(x1 * y2 - x2 * y1), minlength=n_ways)
+    area = np.where(closed, np.abs(twice_area) / 2 * EARTH_RADIUS ** 2, np.nan)
+
+    incomplete = missing > 0
+    length[incomplete] = np.nan
+    area[incomplete] = np.nan
+    return {'id': np.asarray(way_ids, dtype=np.int64), 'nodes': counts, 'missing': missing,
+            'length': length, 'min_lat': min_lat, 'min_lon': min_lon, 'max_lat': max_lat,
+            'max_lon': max_lon, 'closed': closed, 'area': area}
+
+
+class GeometryCollector(object):
+    """Records node coordinates and way refs from an element stream, then computes way_geometry"""
+
+    def __init__(self, path=None, fixed_point=True):
+        self.nodes = NodeStore(path, fixed_point)
+        self.way_ids = ArrayBuilder(np.int64)
+        self.refs = ArrayBuilder(np.int64)
+        self.counts = ArrayBuilder(np.int64)
+
+    def track(self, elements):
+        '''Pass elements straight through, remembering what way_geometry will need'''
+        for elem in elements:
+            if elem.tag == 'node':
+                attrib = elem.attrib
+                if 'lat' in attrib and 'lon' in attrib:
+                    self.nodes.add(int(attrib['id']), float(attrib['lat']), float(attrib['lon']))
+            elif elem.tag == 'way':
+                refs = [int(nd.attrib['ref']) for nd in elem.findall('nd')]
+                self.way_ids.append(int(elem.attrib['id']))
+                self.refs.extend(refs)
+                self.counts.append(len(refs))
+            yield elem
+
+    def result(self):
+        self.nodes.finish()
+        return way_geometry(self.nodes, self.way_ids.array(), self.refs.array(), self.counts.array())
+
+
+def write_way_geometry(geometry, path=WAY_GEOMETRY_PATH):
+    '''Write the output of way_geometry to a csv file, one row per way'''
+    with open(path, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(WAY_GEOMETRY_FIELDS)
+        writer.writerows(zip(*[geometry[field].tolist() for field in WAY_GEOMETRY_FIELDS]))
+
+#geometry = GeometryCollector('seattle_nodes')
+#process_map(in_file, geometry=geometry)
+#write_way_geometry(geometry.result())
+
+
+# process_map on the full download runs for the best part of an hour and used to start again from
+# nothing after a crash or a Ctrl-C.  With checkpoint=path it saves how far it has got every
+# CHECKPOINT_EVERY elements: the byte offset in the (decompressed) input where the last element
+# written starts, the last id of each type, and the length of every csv once the writers have been
+# flushed.  process_map(..., resume=True) cuts the csvs back to those lengths and carries on parsing
+# from that offset.  The offsets come from expat, so a checkpointed run always uses the expat
+# backend; clip, geometry and columnar output keep state that a checkpoint can't hold, and a .pbf
+# has no byte offsets to go back to, so none of those can be checkpointed.
+
+# In[ ]:
+
+CHECKPOINT_PATH = 'process_map.checkpoint'
+CHECKPOINT_EVERY = 100000  # elements
+RESUME_ROOT = '<osm>'  # goes in front of the rest of the file, for the </osm> at its end
+
+
+def skip_input(f, offset, block_size=PARSE_BLOCK):
+    '''Move f on to offset bytes from its start: seek a plain file, read through anything else'''
+    if isinstance(f, file):
+        f.seek(offset)
+        return
+    while offset:
+        data = f.read(min(block_size, offset))
+        if not data:
+            raise IOError('the input ends before the checkpoint offset')
+        offset -= len(data)
+
+
+class OffsetCollector(ExpatCollector):
+    '''ExpatCollector that also keeps the input offset where each record starts, in step with self.done'''
+
+    def __init__(self, tags, parser, base=0):
+        super(OffsetCollector, self).__init__(tags)
+        self.parser = parser
+        self.base = base  # input offset - parser offset
+        self.offsets = []
+
+    def start(self, tag, attrib):
+        self.depth += 1
+        if self.current is not None:
+            self.current.children.append(OSMRecord(tag, attrib))
+        elif tag in self.tags:
+            self.current = OSMRecord(tag, attrib, [])
+            self.current_depth = self.depth
+            self.offsets.append(self.base + self.parser.CurrentByteIndex)
+
+
+def positioned_elements(osm_file, tags=('node', 'way', 'relation'), start=0, block_size=PARSE_BLOCK):
+    '''Yield (offset, OSMRecord) like expat_elements, from the element that starts at offset start on'''
+    if is_pbf(osm_file):
+        raise ValueError('{} has no byte offsets to resume from, only XML can be checkpointed'.format(osm_file))
+    parser = expat.ParserCreate()
+    parser.returns_unicode = False
+    prefix = RESUME_ROOT if start else ''
+    collector = OffsetCollector(tags, parser, start - len(prefix))
+    parser.StartElementHandler = collector.start
+    parser.EndElementHandler = collector.end
+    f = open_osm(osm_file)
+    try:
+        skip_input(f, start)
+        parser.Parse(prefix, False)
+        while True:
+            block = f.read(block_size)
+            parser.Parse(block, not block)
+            for record in zip(collector.offsets, collector.done):
+                yield record
+                if memory_probe.enabled:
+                    memory_probe.count(len(collector.done))
+            del collector.offsets[:len(collector.done)]  # keeping the offset of a record still open
+            del collector.done[:]
+            if not block:
+                break
+    finally:
+        if f is not osm_file:
+            f.close()
+
+
+def input_signature(file_in):
+    '''What a checkpoint keeps to make sure it is resumed on the same input'''
+    return {'input': os.path.abspath(file_in), 'size': os.path.getsize(file_in),
+            'mtime': os.path.getmtime(file_in)}
+
+
+def load_checkpoint(path, file_in):
+    '''The checkpoint saved at path, or None if there isn't one; ValueError if it is for another input'''
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        state = json.load(f)
+    signature = input_signature(file_in)
+    if any(state[key] != value for key, value in signature.items()):
+        raise ValueError('{} was saved for {} as it was then, not {}'.format(path, state['input'], file_in))
+    for output, length in state['outputs'].items():
+        if not os.path.exists(output) or os.path.getsize(output) < length:
+            raise ValueError('{} is shorter than at the checkpoint, start again without resume'.format(output))
+    return state
+
+
+class Checkpointer(object):
+    """Saves a checkpoint for process_map every `every` elements
+
+    track() passes the positioned elements on as plain elements.  When it is
+    asked for the next one, the previous element has been handed to the
+    writers, so that is when it flushes them and saves its offset, tag and id,
+    the last id of each type and the length of every output file to path.
+    """
+
+    def __init__(self, path, file_in, outputs, writers, every=CHECKPOINT_EVERY, state=None):
+        self.path = path
+        self.signature = input_signature(file_in)
+        self.outputs = outputs  # [(output path, open file)]
+        self.writers = writers
+        self.every = every
+        self.last = dict(state['last']) if state else {}
+        self.count = state['elements'] if state else 0
+
+    def track(self, positioned):
+        previous = None
+        for offset, element in positioned:
+            if previous is not None and self.count % self.every == 0:
+                self.save(*previous)
+            yield element
+            previous = offset, element.tag, element.attrib['id']
+            self.last[element.tag] = element.attrib['id']
+            self.count += 1
+
+    def save(self, offset, tag, id_):
+        for writer in self.writers.values():
+            writer.flush()
+        lengths = {}
+        for output, f in self.outputs:
+            f.flush()
+            os.fsync(f.fileno())
+            lengths[output] = f.tell()
+        state = dict(self.signature, offset=offset, element=[tag, id_], last=self.last,
+                     elements=self.count, outputs=lengths, saved=time.time())
+        with open(self.path + '.part', 'w') as f:
+            json.dump(state, f, sort_keys=True)
+        os.rename(self.path + '.part', self.path)
+
+
+def resumed_elements(positioned, state):
+    '''Drop the first of the positioned elements, after checking it is the one the checkpoint was saved after'''
+    for offset, element in positioned:
+        if [element.tag, element.attrib.get('id')] != state['element']:
+            raise ValueError('the input at offset {} is {} {}, but the checkpoint was saved after {} {}'.format(
+                             offset, element.tag, element.attrib.get('id'), *state['element']))
+        break
+    for record in positioned:
+        yield record
+
+
+def resume_output(path, length):
+    '''Open an output file to carry on writing at length, cutting off anything written after that'''
+    f = open(path, 'r+b')
+    f.truncate(length)
+    f.seek(length)
+    return f
+
+
+def process_map(file_in, backend='iterparse', clip=None, geometry=None, columnar=None, checkpoint=None,
+                resume=False): ## ADD RELATIONS
+    """Iteratively process each XML element and write to csv(s)
+
+    If clip is a ClipArea, only the elements inside it are written.  If
+    geometry is a GeometryCollector, it sees every element that is written.
+    columnar='parquet' or 'arrow' also writes every table in that format.
+    checkpoint is a path to save a checkpoint to every CHECKPOINT_EVERY
+    elements (parsing with expat whatever backend says); with resume=True the
+    run carries on from the checkpoint there (CHECKPOINT_PATH if no path is
+    given) or starts from the beginning if there isn't one.  The checkpoint is
+    removed when the run finishes.
+    """
+    if columnar and pa is None:
+        raise ImportError('columnar output needs pyarrow')
+    if resume and checkpoint is None:
+        checkpoint = CHECKPOINT_PATH
+    if checkpoint and (clip is not None or geometry is not None or columnar):
+        raise ValueError("clip, geometry and columnar output can't be checkpointed")
+    state = load_checkpoint(checkpoint, file_in) if resume else None
+    if state:
+        print 'Resuming {} after {} {} (element {:,})'.format(file_in, state['element'][0], state['element'][1],
+                                                              state['elements'])
+    files = [resume_output(path, state['outputs'][path]) if state else codecs.open(path, 'w')
+             for _, path, _ in CSV_OUTPUTS]
+    columnar_writers = []
+    stage = instrumentation.stage('process_map', file_in) if instrumentation.enabled else None
+    source = stage.source(file_in) if stage else file_in
+    try:
+        writers = {}
+        for f, (key, path, fields) in zip(files, CSV_OUTPUTS):
+            writers[key] = UnicodeTupleWriter(f, fields)
+            if not state:
+                writers[key].writeheader()
+            if columnar:
+                columnar_writers.append(ColumnarWriter(columnar_path(path, columnar), fields, columnar))
+                writers[key] = TeeWriter(writers[key], columnar_writers[-1])
+        if checkpoint:
+            outputs = [(path, f) for f, (_, path, _) in zip(files, CSV_OUTPUTS)]
+            checkpoints = Checkpointer(checkpoint, file_in, outputs, writers, state=state)
+            positioned = positioned_elements(source, start=state['offset'] if state else 0)
+            elements = checkpoints.track(resumed_elements(positioned, state) if state else positioned)
+        else:
+            elements = get_element(source, tags=('node', 'way', 'relation'), backend=backend)
+        if clip is not None:
+            clipper = Clipper(clip)
+            elements = clip_elements(elements, clipper)
+        if geometry is not None:
+            elements = geometry.track(elements)
+        write_rows(elements, writers, stage)
+        for writer in columnar_writers:
+            writer.close()
+    finally:
+        for f in files:
+            f.close()
+        if stage is not None:
+            stage.finish()
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    tag_keys.report()
+    if clip is not None:
+        clipper.report()
+
+#process_map(in_file, checkpoint=CHECKPOINT_PATH)
+#process_map(in_file, resume=True)  # after an interruption
 
 class UnicodeDictWriter(csv.DictWriter, object):
     """Extend csv.DictWriter to handle Unicode input"""
@@ -685,8 +2836,653 @@ class UnicodeDictWriter(csv.DictWriter, object):
         for row in rows:
             self.writerow(row)
 
+
+CSV_BATCH_SIZE = 10000
+
+
+class UnicodeTupleWriter(object):
+    """Batched csv writer for the tuple rows from shape_rows
+
+    Rows are collected and handed to csv.writer.writerows batch_size at a time.
+    Almost every value is a plain str, so a batch is written as it is and only
+    encoded field by field if it turns out to hold non-ascii unicode.
+    """
+
+    def __init__(self, f, fields, batch_size=CSV_BATCH_SIZE):
+        self.f = f
+        self.fields = fields
+        self.batch_size = batch_size
+        self.batch = []
+
+    def writeheader(self):
+        csv.writer(self.f).writerow(self.fields)
+
+    def writerow(self, row):
+        self.batch.append(row)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def writerows(self, rows):
+        self.batch.extend(rows)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        # goes through a buffer so a batch that fails to encode never leaves half its rows in the file
+        buf = io.BytesIO()
+        try:
+            csv.writer(buf).writerows(self.batch)
+        except UnicodeEncodeError:
+            buf = io.BytesIO()
+            csv.writer(buf).writerows([[v.encode('utf-8') if isinstance(v, unicode) else v for v in row]
+                                       for row in self.batch])
+        self.f.write(buf.getvalue())
+        del self.batch[:]
+
+
+def write_shaped(rows, writers):
+    '''Send the rows of one shape_rows result to writers[output key]'''
+    if rows:
+        for key, value in rows.items():
+            if key in ENTITY_KEYS:
+                writers[key].writerow(value)
+            else:
+                writers[key].writerows(value)
+
+
+def write_rows(elements, writers, stage=None):
+    '''Shape elements with shape_rows, send each row to writers[output key] and flush them at the end
+
+    With a StageCounters from instrumentation, the loop is run and timed by it.
+    '''
+    if stage is None:
+        for element in elements:
+            write_shaped(shape_rows(element), writers)
+    else:
+        stage.run(elements, shape_rows, lambda element, rows: write_shaped(rows, writers))
+    for writer in writers.values():
+        writer.flush()
+
+
+# The pandas cells read the csv files straight back in, parsing every id and coordinate from text
+# again and holding keys, types and user names as millions of separate Python strings.  With
+# process_map(..., columnar='parquet') every table is also written as a typed columnar file next to
+# its csv: int64 ids, float64 coordinates, UTC timestamps, and key/type/user/role dictionary encoded.
+# Rows go out one row group (COLUMNAR_ROW_GROUP rows) at a time, so memory use doesn't grow with the
+# file.  'arrow' writes the same tables as Arrow IPC files (not feather, which the pyarrow versions
+# that still run on Python 2 can only write a whole table at a time), with key/type/user/role as plain
+# strings, because an IPC file can't change a column's dictionary from one batch to the next.  Both
+# need pyarrow; read_columnar() loads either one back and check_columnar() round-trips them.
+
+# In[ ]:
+
+COLUMNAR_ROW_GROUP = 100000
+COLUMNAR_FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+INT_COLUMNS = frozenset(['id', 'uid', 'version', 'changeset', 'node_id', 'position', 'reference'])
+FLOAT_COLUMNS = frozenset(['lat', 'lon'])
+DICTIONARY_COLUMNS = frozenset(['key', 'type', 'user', 'role'])
+
+
+def columnar_path(csv_path, fmt):
+    '''nodes.csv -> nodes.parquet'''
+    return os.path.splitext(csv_path)[0] + COLUMNAR_FORMATS[fmt]
+
+
+def column_type(field, fmt):
+    if field in INT_COLUMNS:
+        return pa.int64()
+    if field in FLOAT_COLUMNS:
+        return pa.float64()
+    if field == 'timestamp':
+        return pa.timestamp('s', tz='UTC')
+    if field in DICTIONARY_COLUMNS and fmt == 'parquet':
+        return pa.dictionary(pa.int32(), pa.string())
+    return pa.string()
+
+
+def column_values(field, values):
+    '''Convert one column of shape_rows strings to what pa.array wants for column_type(field)'''
+    if field in INT_COLUMNS:
+        return [int(v) if v is not None else None for v in values]
+    if field in FLOAT_COLUMNS:
+        return [float(v) if v is not None else None for v in values]
+    if field == 'timestamp':
+        return [time_columns(v)[0] for v in values]
+    return [v.decode('utf-8') if isinstance(v, str) else v for v in values]
+
+
+class ColumnarWriter(object):
+    """Write shape_rows tuples to a parquet or Arrow IPC file, one row group (or record batch) at a time
+
+    Has the same writerow/writerows/flush methods as UnicodeTupleWriter; call
+    close() at the end to finish the file.
+    """
+
+    def __init__(self, path, fields, fmt='parquet', row_group=COLUMNAR_ROW_GROUP):
+        if pa is None:
+            raise ImportError('columnar output needs pyarrow')
+        if fmt not in COLUMNAR_FORMATS:
+            raise ValueError('unknown columnar format %r' % (fmt,))
+        self.fields = fields
+        self.fmt = fmt
+        self.row_group = row_group
+        self.schema = pa.schema([pa.field(field, column_type(field, fmt)) for field in fields])
+        if fmt == 'parquet':
+            self.writer = pq.ParquetWriter(path, self.schema)
+        else:
+            self.sink = pa.OSFile(path, 'wb')
+            self.writer = pa.RecordBatchFileWriter(self.sink, self.schema)
+        self.batch = []
+
+    def writeheader(self):
+        pass
+
+    def writerow(self, row):
+        self.batch.append(row)
+        if len(self.batch) >= self.row_group:
+            self.flush()
+
+    def writerows(self, rows):
+        self.batch.extend(rows)
+        if len(self.batch) >= self.row_group:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        columns = []
+        for field, values in zip(self.schema, zip(*self.batch)):
+            if pa.types.is_dictionary(field.type):
+                columns.append(pa.array(column_values(field.name, values), pa.string()).dictionary_encode())
+            else:
+                columns.append(pa.array(column_values(field.name, values), field.type))
+        batch = pa.RecordBatch.from_arrays(columns, self.fields)
+        if self.fmt == 'parquet':
+            self.writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+        del self.batch[:]
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        if self.fmt == 'arrow':
+            self.sink.close()
+
+
+class TeeWriter(object):
+    """Send every row to several writers"""
+
+    def __init__(self, *writers):
+        self.writers = writers
+
+    def writeheader(self):
+        for writer in self.writers:
+            writer.writeheader()
+
+    def writerow(self, row):
+        for writer in self.writers:
+            writer.writerow(row)
+
+    def writerows(self, rows):
+        for writer in self.writers:
+            writer.writerows(rows)
+
+    def flush(self):
+        for writer in self.writers:
+            writer.flush()
+
+
+def read_columnar(csv_path, fmt='parquet'):
+    '''Load the columnar file written next to csv_path into a DataFrame'''
+    path = columnar_path(csv_path, fmt)
+    if fmt == 'parquet':
+        return pd.read_parquet(path)
+    # a file object, as pyarrow takes a Python 2 str for the bytes of the file rather than its path
+    return pa.ipc.open_file(pa.memory_map(path)).read_pandas()
+
+
+def csv_column(field, values):
+    '''The values of one column of a csv written by process_map, as check_columnar compares them'''
+    if field in INT_COLUMNS:
+        return [int(v) if v else None for v in values]
+    if field in FLOAT_COLUMNS:
+        return [float(v) if v else None for v in values]
+    if field == 'timestamp':
+        return [time_columns(v)[0] for v in values]
+    return [v.decode('utf-8') for v in values]
+
+
+def frame_column(field, values):
+    '''The values of one column of a read_columnar DataFrame, as check_columnar compares them'''
+    if field == 'timestamp':
+        return [None if pd.isnull(v) else calendar.timegm(v.utctimetuple()) for v in values]
+    if field in INT_COLUMNS:
+        return [None if pd.isnull(v) else int(v) for v in values]
+    if field in FLOAT_COLUMNS:
+        return [None if pd.isnull(v) else float(v) for v in values]
+    return [u'' if v is None else v for v in values]  # the csv writes None as an empty field
+
+
+def check_columnar(file_in, formats=('parquet', 'arrow')):
+    '''process_map file_in in each format and read every table back: {fmt: True if all match their csv}'''
+    results = {}
+    for fmt in formats:
+        process_map(file_in, columnar=fmt)
+        results[fmt] = True
+        for _, path, fields in CSV_OUTPUTS:
+            frame = read_columnar(path, fmt)
+            text = pd.read_csv(path, dtype=object, keep_default_na=False)
+            same = (list(frame.columns) == fields and len(frame) == len(text) and
+                    all(frame_column(field, frame[field]) == csv_column(field, text[field]) for field in fields))
+            print '{:8} {:20} {:10,} rows  {}'.format(fmt, os.path.basename(path), len(frame),
+                                                     'ok' if same else 'DIFFERENT')
+            results[fmt] = results[fmt] and same
+    return results
+
+#check_columnar(sample_file)
+
+
+def benchmark_shaping(file_in, repeat=5, copies=1000):
+    """Compare shape_element + UnicodeDictWriter against shape_rows + UnicodeTupleWriter
+
+    The elements of file_in are parsed once and then shaped copies times over
+    into in-memory csv files, so only the shaping and writing are timed.
+    """
+    elements = list(get_element(file_in)) * copies
+
+    def dict_path():
+        writers = dict((key, UnicodeDictWriter(io.BytesIO(), fields)) for key, _, fields in CSV_OUTPUTS)
+        for element in elements:
+            el = shape_element(element)
+            if el:
+                for key, value in el.items():
+                    if key in ENTITY_KEYS:
+                        writers[key].writerow(value)
+                    else:
+                        writers[key].writerows(value)
+
+    def tuple_path():
+        writers = dict((key, UnicodeTupleWriter(io.BytesIO(), fields)) for key, _, fields in CSV_OUTPUTS)
+        for element in elements:
+            rows = shape_rows(element)
+            if rows:
+                for key, value in rows.items():
+                    if key in ENTITY_KEYS:
+                        writers[key].writerow(value)
+                    else:
+                        writers[key].writerows(value)
+        for writer in writers.values():
+            writer.flush()
+
+    old = min(timeit.repeat(dict_path, number=1, repeat=repeat))
+    new = min(timeit.repeat(tuple_path, number=1, repeat=repeat))
+    print 'dict rows:  {:,.0f} elements/sec'.format(len(elements) / old)
+    print 'tuple rows: {:,.0f} elements/sec ({:.1f}x)'.format(len(elements) / new, old / new)
+    return old, new
+
+#benchmark_shaping(sample_file)
+
 #if __name__ == '__main__':
 #    process_map(in_file)
+#    process_map(in_file, clip=ClipArea(KING_COUNTY))  # leave out everything outside King County
+
+
+# process_map only keeps one core busy, which is slow on 7.2 million nodes. The parallel version
+# below cuts the file into byte ranges that always start at a <node>, <way> or <relation> tag,
+# shapes each range in a process pool and then stitches the per-range csv shards back together
+# in file order, so the output is identical to process_map.
+
+# In[ ]:
+
+CHUNK_SIZE = 32 * 1024 * 1024
+ELEMENT_START = re.compile(br'<(?:node|way|relation)[\s/>]')
+
+
+def next_element_start(f, pos, block_size=1024 * 1024):
+    '''Return the offset of the first top level element tag at or after pos, or None'''
+    while True:
+        f.seek(pos)
+        block = f.read(block_size)
+        if not block:
+            return None
+        m = ELEMENT_START.search(block)
+        if m:
+            return pos + m.start()
+        if len(block) < block_size:
+            return None
+        pos += block_size - 16  # overlap so a tag split across two blocks is still found
+
+
+def osm_end(f):
+    '''Return the offset of the closing </osm> tag of the open file f, or its size if it is missing'''
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(max(0, size - 4096))
+    tail = f.read()
+    return size - len(tail) + tail.rfind(b'</osm>') if b'</osm>' in tail else size
+
+
+def find_chunk_offsets(file_in, chunk_size=CHUNK_SIZE):
+    '''Split file_in into byte ranges of about chunk_size that begin at element boundaries
+
+    Returns a list of offsets; range i is offsets[i]:offsets[i + 1] and the last
+    offset is the position of the closing </osm> tag.
+    '''
+    offsets = []
+    with open(file_in, 'rb') as f:
+        end = osm_end(f)
+        pos = 0
+        while pos < end:
+            start = next_element_start(f, pos)
+            if start is None or start >= end:
+                break
+            offsets.append(start)
+            pos = start + chunk_size
+    offsets.append(end)
+    return offsets
+
+
+def shape_chunk(job):
+    '''Shape every element in one byte range of the input into its own set of csv shards
+
+    Returns the shard prefix and the tag keys this worker saw, so the parent's
+    tag_keys table ends up with the keys of the whole file.
+    '''
+    file_in, start, end, shard_prefix, backend = job
+    with open(file_in, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    source = io.BytesIO(b'<osm>' + data + b'</osm>')
+    shards = [open(shard_prefix + path, 'wb') for _, path, _ in CSV_OUTPUTS]
+    try:
+        writers = dict((key, UnicodeTupleWriter(shard, fields))
+                       for shard, (key, _, fields) in zip(shards, CSV_OUTPUTS))
+        write_rows(get_element(source, tags=('node', 'way', 'relation'), backend=backend), writers)
+    finally:
+        for shard in shards:
+            shard.close()
+    return shard_prefix, tag_keys.table.keys()
+
+
+def process_map_parallel(file_in, workers=None, chunk_size=CHUNK_SIZE, backend='iterparse'):
+    """Same output as process_map, but the shaping is spread over a pool of worker processes"""
+    check_uncompressed(file_in)
+    offsets = find_chunk_offsets(file_in, chunk_size)
+    shard_dir = tempfile.mkdtemp(prefix='osm_shards_', dir='.')
+    jobs = [(file_in, offsets[i], offsets[i + 1], os.path.join(shard_dir, '{:06d}_'.format(i)), backend)
+            for i in range(len(offsets) - 1)]
+    outputs = [open(path, 'wb') for _, path, _ in CSV_OUTPUTS]
+    pool = multiprocessing.Pool(workers)
+    try:
+        for out, (_, _, fields) in zip(outputs, CSV_OUTPUTS):
+            UnicodeTupleWriter(out, fields).writeheader()
+        # imap hands the shards back in chunk order, so rows come out in file order
+        for shard_prefix, keys in pool.imap(shape_chunk, jobs):
+            for k in keys:
+                tag_keys.classify(k)
+            for out, (_, path, _) in zip(outputs, CSV_OUTPUTS):
+                with open(shard_prefix + path, 'rb') as shard:
+                    shutil.copyfileobj(shard, out, 1024 * 1024)
+                os.remove(shard_prefix + path)
+        pool.close()
+        tag_keys.report()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        for out in outputs:
+            out.close()
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+#if __name__ == '__main__':
+#    process_map_parallel(in_file)
+
+
+# create_sample_file above reads the whole 1.6 GB file to keep every kth element, and the sample it
+# writes has ways pointing at nodes that are not in it.  The sampler below seeks to random byte
+# offsets instead and resyncs on the next element tag, so it only reads the elements it keeps.
+#
+# It relies on the extract being sorted the way OSM files are: all nodes, then ways, then relations,
+# each by id.  The byte range of each element type is found with a binary search, each type gets its
+# own quota, and with closure=True the nodes used by the sampled ways and relations are looked up
+# by id (another binary search) so the sample can be loaded without dangling references.
+# method='reservoir' does one full pass instead and keeps an exactly uniform sample of each type.
+
+# In[ ]:
+
+SEEK_BLOCK = 4096
+SEEK_WINDOW = 64 * 1024
+ELEMENT_ORDER = ('node', 'way', 'relation')
+START_TAG = re.compile(br'<(node|way|relation)((?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*)\s*(/?)>')
+NODE_TAG = re.compile(br'<node\s(?:[^>"\']|"[^"]*"|\'[^\']*\')*>')
+ID_ATTR = re.compile(br'\sid\s*=\s*["\'](-?\d+)["\']')
+
+
+def element_tag_at(f, pos):
+    '''Return the element type of the top level element starting at pos'''
+    f.seek(pos)
+    m = re.match(br'<(node|way|relation)', f.read(16))
+    return m.group(1)
+
+
+def read_element_at(f, pos):
+    '''Parse the top level element that starts at byte offset pos, returns (element, end offset)'''
+    f.seek(pos)
+    data = f.read(SEEK_BLOCK)
+    while True:
+        m = START_TAG.match(data)
+        if m and m.group(3):
+            end = m.end()
+            break
+        if m:
+            end = data.find(b'</' + m.group(1) + b'>', m.end())
+            if end != -1:
+                end += len(m.group(1)) + 3
+                break
+        more = f.read(len(data))
+        if not more:
+            raise ValueError('no complete element at offset %d' % pos)
+        data += more
+    return ET.fromstring(data[:end]), pos + end
+
+
+def element_regions(f):
+    '''Find the byte range of each element type in a file sorted nodes, ways, relations
+
+    Returns {tag: (start, end)} for the types present in the file.
+    '''
+    end = osm_end(f)
+    first = next_element_start(f, 0, SEEK_BLOCK)
+    if first is None or first >= end:
+        return {}
+    bounds = [first]
+    for rank in (1, 2):
+        # smallest offset whose next element is of this rank or later
+        lo, hi = bounds[-1], end
+        if lo < end and ELEMENT_ORDER.index(element_tag_at(f, lo)) >= rank:
+            bounds.append(lo)
+            continue
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            start = next_element_start(f, mid, SEEK_BLOCK)
+            if start is None or start >= end or ELEMENT_ORDER.index(element_tag_at(f, start)) >= rank:
+                hi = mid
+            else:
+                lo = mid
+        start = next_element_start(f, hi, SEEK_BLOCK) if hi < end else None
+        bounds.append(end if start is None or start >= end else start)
+    bounds.append(end)
+    return dict((tag, (bounds[i], bounds[i + 1])) for i, tag in enumerate(ELEMENT_ORDER)
+                if bounds[i] < bounds[i + 1])
+
+
+def seek_offsets(f, region, quota, rng, max_tries=None):
+    '''Return up to quota distinct element offsets drawn at random from region
+
+    Each draw is a random byte in the region followed by a resync to the next
+    element, so an element's chance of being picked goes with the size of the
+    element before it; for elements of one type that is close to uniform.  If
+    the draws run out before the quota is met, the region is listed in full.
+    '''
+    start, end = region
+    if max_tries is None:
+        max_tries = 10 * quota + 100
+    picked = set()
+    for _ in xrange(max_tries):
+        if len(picked) >= quota:
+            break
+        pos = next_element_start(f, rng.randrange(start, end), SEEK_BLOCK)
+        if pos is not None and pos < end:
+            picked.add(pos)
+    if len(picked) < quota:
+        # the quota is close to the number of elements in the region, so list them all instead
+        starts = []
+        pos = start
+        while pos is not None and pos < end:
+            starts.append(pos)
+            pos = next_element_start(f, pos + 1, SEEK_BLOCK)
+        picked = rng.sample(starts, min(quota, len(starts)))
+    return sorted(picked)
+
+
+def estimate_counts(file_in, probes=200, seed=0):
+    '''Estimate the number of elements of each type from the mean size of a few random elements'''
+    check_uncompressed(file_in)
+    rng = random.Random(seed)
+    counts = {}
+    with open(file_in, 'rb') as f:
+        for tag, region in element_regions(f).items():
+            sizes = []
+            for pos in seek_offsets(f, region, probes, rng):
+                _, elem_end = read_element_at(f, pos)
+                nxt = next_element_start(f, elem_end, SEEK_BLOCK)
+                sizes.append((min(nxt, region[1]) if nxt is not None else region[1]) - pos)
+            counts[tag] = int(round((region[1] - region[0]) / (float(sum(sizes)) / len(sizes))))
+    return counts
+
+
+def reservoir_sample(file_in, quotas, rng, backend='iterparse'):
+    '''One pass over file_in keeping a uniform random sample of quotas[tag] elements of each type'''
+    reservoirs = dict((tag, []) for tag in quotas)
+    seen = defaultdict(int)
+    for element in get_element(file_in, tags=tuple(quotas), backend=backend):
+        reservoir, quota = reservoirs[element.tag], quotas[element.tag]
+        n = seen[element.tag]
+        seen[element.tag] += 1
+        if n < quota:
+            reservoir.append(element)
+        else:
+            j = rng.randint(0, n)
+            if j < quota:
+                reservoir[j] = element
+    return [element for tag in ELEMENT_ORDER for element in reservoirs.get(tag, [])]
+
+
+def referenced_node_ids(elements):
+    '''Return the ids of the nodes used by the ways and relations in elements'''
+    ids = set()
+    for element in elements:
+        if element.tag == 'way':
+            ids.update(int(nd.attrib['ref']) for nd in element.findall('nd'))
+        elif element.tag == 'relation':
+            ids.update(int(m.attrib['ref']) for m in element.findall('member') if m.attrib['type'] == 'node')
+    return ids
+
+
+def element_id_at(f, pos):
+    f.seek(pos)
+    return int(ID_ATTR.search(START_TAG.match(f.read(SEEK_BLOCK)).group(2)).group(1))
+
+
+def fetch_nodes(f, region, ids):
+    '''Look up the nodes with the given ids in the node region of a file sorted by id
+
+    Returns (nodes, missing ids).  Wanted ids are taken in order, and every node
+    in a 64 KB window is checked before seeking again, so ids that sit close
+    together in the file (as the nodes of one way usually do) share a seek.
+    '''
+    wanted = sorted(ids)
+    nodes, missing = [], []
+    lo, end = region
+    i = 0
+    while i < len(wanted):
+        target = wanted[i]
+        hi = end
+        while hi - lo > SEEK_WINDOW // 2:
+            mid = (lo + hi) // 2
+            pos = next_element_start(f, mid, SEEK_BLOCK)
+            if pos is None or pos >= hi or element_id_at(f, pos) > target:
+                hi = mid
+            else:
+                lo = pos
+        f.seek(lo)
+        window = f.read(min(SEEK_WINDOW, end - lo))
+        last_pos = None
+        for m in NODE_TAG.finditer(window):
+            node_id = int(ID_ATTR.search(m.group()).group(1))
+            while i < len(wanted) and wanted[i] < node_id:
+                missing.append(wanted[i])
+                i += 1
+            if i == len(wanted):
+                break
+            if wanted[i] == node_id:
+                nodes.append(read_element_at(f, lo + m.start())[0])
+                i += 1
+            last_pos = lo + m.start()
+        if i < len(wanted) and wanted[i] == target:
+            # nothing in the window reached the target, so it is not in the file
+            missing.append(target)
+            i += 1
+        if last_pos is not None:
+            lo = last_pos
+    return nodes, missing
+
+
+def sample_osm(in_file, out_file, quotas, seed=0, method='seek', closure=False, backend='iterparse'):
+    '''Write a random sample of in_file with up to quotas[tag] elements of each type to out_file
+
+    quotas maps 'node', 'way' and 'relation' to a number of elements; for a 1%
+    extract use the counts from estimate_counts divided by 100.  The same seed
+    gives the same sample.  Returns the number of elements written per type and
+    the number of referenced nodes that could not be found.
+    '''
+    check_uncompressed(in_file)
+    rng = random.Random(seed)
+    with open(in_file, 'rb') as f:
+        regions = element_regions(f)
+        if method == 'seek':
+            elements = [read_element_at(f, pos)[0]
+                        for tag in ELEMENT_ORDER if quotas.get(tag) and tag in regions
+                        for pos in seek_offsets(f, regions[tag], quotas[tag], rng)]
+        elif method == 'reservoir':
+            elements = reservoir_sample(in_file, quotas, rng, backend)
+        else:
+            raise ValueError('unknown sampling method %r' % (method,))
+        missing = []
+        if closure:
+            have = set(int(e.attrib['id']) for e in elements if e.tag == 'node')
+            wanted = referenced_node_ids(elements) - have
+            if wanted and 'node' in regions:
+                nodes, missing = fetch_nodes(f, regions['node'], wanted)
+                elements.extend(nodes)
+            else:
+                missing = sorted(wanted)
+    elements.sort(key=lambda e: (ELEMENT_ORDER.index(e.tag), int(e.attrib['id'])))
+    counts = defaultdict(int)
+    with OSMWriter(out_file) as writer:
+        for element in elements:
+            writer.write(element)
+            counts[element.tag] += 1
+    return dict(counts), len(missing)
+
+# 1% extract with the ways and relations complete:
+#   quotas = dict((tag, n // 100) for tag, n in estimate_counts(in_file).items())
+#   sample_osm(in_file, sample_file, quotas, seed=1, closure=True)
 
 
 # Since the csv files are easier to handle than the OSM files, this is a good time to look through the data 
@@ -704,6 +3500,8 @@ w_nodes = pd.read_csv(way_nodes)
 w_tags = pd.read_csv(ways_tags)
 n_tags = pd.read_csv(nodes_tags)
 nodes = pd.read_csv(ns)
+# after process_map(in_file, columnar='parquet') the typed files load much faster:
+#n_tags = read_columnar(nodes_tags)
 
 n_values = n_tags['value'].unique() # see unique values of nodes
 
@@ -714,19 +3512,9 @@ n_values = n_tags['value'].unique() # see unique values of nodes
 ## Remove the key values of 'fixme' and 'removed' from csv files
 # there are over 2000 places where key = 'fixme'    
 # in the ways and nodes fields, these are incomplete entries and have been removed.
-
-w_tags = w_tags[w_tags['key'] != 'fixme']
-n_tags = n_tags[n_tags['key'] != 'fixme'] 
-w_tags = w_tags[w_tags['type'] != 'not']
-n_tags = n_tags[n_tags['type'] != 'not']
-w_tags = w_tags[w_tags['type'] != 'removed']
-n_tags = n_tags[n_tags['type'] != 'removed']
-
-
-
 # 'centre' should be changed to 'center' in the value column
-index_centre = n_tags[n_tags['value'] == 'centre'].index.tolist()
-n_tags.iloc[index_centre,2] = 'center'
+# Both are rules in TAG_RULES now, so shape_rows leaves these tags out (or fixes them) before
+# the csv files are written, and there is nothing left to filter here.
 
 # need to convert date time to something sqlite3 can handle?
 '''A time string can be in any of the following formats:
@@ -750,10 +3538,6 @@ https://www.sqlite.org/lang_datefunc.html
 # ...it can handle it fine!
 
 
-## replace old csv files with new ones
-n_tags.to_csv('nodes_tags.csv', index=False)
-w_tags.to_csv('ways_tags.csv', index=False)
-
 
 # One of the things I absolutely HAVE to know about Seattle if I'm ever going to move there is whether there are enough indian restaurants to fulfill my frequent cravings. I was concerned about how the cuisine entries were entered (i.e., are all of the types of restaurants categorized in a way that makes sense?)
 
@@ -763,15 +3547,7 @@ uni_cuisine_types = all_rest['value'][all_rest['key'] == 'cuisine'].index.tolist
 
 
 # turns out there are three different ways that indian restaurants are categorized: 'indian', 'Nepalese,_Indian,_Tibetan', and 'Indian,_South_East_Asian'. I decided to change all of these to 'indian' to make it easier to access the information on indian restaurants.
-
-# In[ ]:
-
-indian_id1 = n_tags[n_tags['value'] == 'Nepalese,_Indian,_Tibetan'].index.tolist()
-indian_id2 = n_tags[n_tags['value'] == 'Indian,_South_East_Asian'].index.tolist()
-
-
-n_tags.iloc[indian_id1,2] = 'indian'
-n_tags.iloc[indian_id2, 2]= 'indian'
+# (the last two cuisine rules in TAG_RULES, so the change ends up in the csv files and the database)
 
 
 # # Import .csv files into sqlite3 and QUERY!
@@ -781,10 +3557,10 @@ n_tags.iloc[indian_id2, 2]= 'indian'
 #within the sqlite3 command line I input:
 '''
 .open seattle.db
-create table ways_tags(id, key, value, type);
+create table ways_tags(id, key, value, type, norm);
 .mode csv
 .import way_tags.csv way_tags
-create table ways_tags(id, key, value, type);
+create table ways_tags(id, key, value, type, norm);
 .mode csv
 .import ways_tags.csv ways_tags
 create table ways(id, user, uid, version, changeset, timestamp);
@@ -793,10 +3569,10 @@ create table ways(id, user, uid, version, changeset, timestamp);
 create table ways_nodes(id, node_id, position);
 .mode csv
 .import ways_nodes.csv ways_nodes
-create table rels_members(reference, role, type);
+create table rels_members(id, reference, role, type);
 .mode csv
 .import rels_members.csv rels_members
-create table rels_tags(id, key, value, type);
+create table rels_tags(id, key, value, type, norm);
 .mode csv
 .import rels_tags.csv rels_tags
 create table relations(id, user, uid, version, changeset, timestamp)
@@ -805,6 +3581,904 @@ create table relations(id, user, uid, version, changeset, timestamp)
 '''
 
 
+# Typing those .import commands by hand is error prone (way_tags.csv vs ways_tags.csv, rels_members.csv
+# vs rel_members.csv...) and means writing 20 million rows to csv only to read them straight back in.
+# load_db() skips the csv files: it builds all of the tables in one go and inserts the output of
+# shape_element directly, in batches with executemany inside large transactions.
+
+# In[ ]:
+
+DB_PATH = 'seattle.db'
+
+# table name -> shape_element output key and columns, same tables as the .import recipe above
+DB_TABLES = [('nodes', 'node', NODE_FIELDS),
+             ('nodes_tags', 'node_tags', NODE_TAGS_FIELDS),
+             ('ways', 'way', WAY_FIELDS),
+             ('ways_nodes', 'way_nodes', WAY_NODES_FIELDS),
+             ('ways_tags', 'way_tags', WAY_TAGS_FIELDS),
+             ('relations', 'relation', REL_FIELDS),
+             ('rels_members', 'rel_members', REL_MEMBERS_FIELDS),
+             ('rels_tags', 'rel_tags', REL_TAGS_FIELDS)]
+
+# the database is rebuilt from scratch on every load, so there is nothing to protect with a journal
+BULK_PRAGMAS = ['PRAGMA journal_mode = OFF',
+                'PRAGMA synchronous = OFF',
+                'PRAGMA temp_store = MEMORY',
+                'PRAGMA cache_size = -262144']  # 256 MB
+
+BATCH_SIZE = 50000
+ROWS_PER_COMMIT = 1000000
+
+# nodes, ways and relations also get the timestamp as integers so the year/month reports can use an index
+TIME_COLUMNS = ['epoch', 'year', 'month']
+
+# column types, anything not listed here is TEXT
+COLUMN_TYPES = {'id': 'INTEGER', 'lat': 'REAL', 'lon': 'REAL', 'uid': 'INTEGER', 'version': 'INTEGER',
+                'changeset': 'INTEGER', 'node_id': 'INTEGER', 'position': 'INTEGER', 'reference': 'INTEGER',
+                'epoch': 'INTEGER', 'year': 'INTEGER', 'month': 'INTEGER'}
+
+# (table, columns) for every index; these are built after the load, which is much
+# faster than keeping them up to date one row at a time
+DB_INDEXES = [('nodes_tags', 'key, value'), ('nodes_tags', 'key, norm'), ('nodes_tags', 'id'),
+              ('ways_tags', 'key, value'), ('ways_tags', 'key, norm'), ('ways_tags', 'value'), ('ways_tags', 'id'),
+              ('rels_tags', 'key, value'), ('rels_tags', 'id'), ('rels_members', 'id'),
+              ('ways_nodes', 'id, position'), ('ways_nodes', 'node_id'),
+              ('nodes', 'user'), ('nodes', 'year, month'),
+              ('ways', 'user'), ('ways', 'year, month'),
+              ('relations', 'user'), ('relations', 'year, month')]
+
+_day_epochs = {}
+
+
+def time_columns(timestamp):
+    '''Return (epoch, year, month) for an OSM timestamp like 2016-02-27T00:03:41Z'''
+    if not timestamp:
+        return (None, None, None)
+    day = timestamp[:10]
+    if day not in _day_epochs:
+        _day_epochs[day] = calendar.timegm((int(day[:4]), int(day[5:7]), int(day[8:10]), 0, 0, 0))
+    seconds = int(timestamp[11:13]) * 3600 + int(timestamp[14:16]) * 60 + int(timestamp[17:19])
+    return (_day_epochs[day] + seconds, int(day[:4]), int(day[5:7]))
+
+
+def table_columns(key, fields):
+    '''Columns of the table for a shape_element key: its fields plus the time columns for nodes/ways/relations'''
+    return fields + TIME_COLUMNS if key in ENTITY_KEYS else fields
+
+
+def create_tables(conn):
+    '''Drop and re-create every table in DB_TABLES with typed columns'''
+    for table, key, fields in DB_TABLES:
+        columns = []
+        for column in table_columns(key, fields):
+            column_def = '{} {}'.format(column, COLUMN_TYPES.get(column, 'TEXT'))
+            if column == 'id' and key in ENTITY_KEYS:
+                column_def += ' PRIMARY KEY'
+            columns.append(column_def)
+        conn.execute('DROP TABLE IF EXISTS {}'.format(table))
+        conn.execute('CREATE TABLE {}({})'.format(table, ', '.join(columns)))
+
+
+def build_indexes(db_path=DB_PATH):
+    '''Create the DB_INDEXES on a loaded database and update the query planner statistics'''
+    conn = sqlite3.connect(db_path)
+    for pragma in BULK_PRAGMAS:
+        conn.execute(pragma)
+    for table, columns in DB_INDEXES:
+        name = '{}_{}'.format(table, columns.replace(', ', '_'))
+        conn.execute('CREATE INDEX IF NOT EXISTS {} ON {}({})'.format(name, table, columns))
+    conn.execute('ANALYZE')
+    conn.commit()
+    conn.close()
+
+
+# The reports below count the same things on every run: elements per user, per year and month, and
+# how often each tag value is used.  AggregateCounts keeps those counts while the rows stream into
+# the database and writes them to three small summary tables (user_counts, month_counts and
+# tag_counts), so a report reads a few hundred rows instead of scanning millions.  apply_changes
+# updates the counts for the elements it changes; refresh_aggregates() rebuilds them from scratch.
+
+# In[ ]:
+
+# summary table -> the columns it is grouped by; every table also has a num column
+AGGREGATE_TABLES = [('user_counts', ['entity', 'user', 'uid']),
+                    ('month_counts', ['entity', 'year', 'month']),
+                    ('tag_counts', ['entity', 'type', 'key', 'value'])]
+
+# the counts are written out whenever this many different groups are waiting
+AGGREGATE_FLUSH = 500000
+
+TAG_ENTITY = {'node_tags': 'node', 'way_tags': 'way', 'rel_tags': 'relation'}
+ENTITY_TAGS = dict((entity, key) for key, entity in TAG_ENTITY.items())
+USER_FIELD = dict((key, OUTPUT_FIELDS[key].index('user')) for key in ENTITY_KEYS)
+
+
+def table_exists(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,)).fetchone() is not None
+
+
+def create_aggregate_tables(conn):
+    '''Drop and re-create the AGGREGATE_TABLES, empty'''
+    for table, columns in AGGREGATE_TABLES:
+        conn.execute('DROP TABLE IF EXISTS {}'.format(table))
+        conn.execute('CREATE TABLE {}({}, num INTEGER)'.format(
+            table, ', '.join('{} {}'.format(c, COLUMN_TYPES.get(c, 'TEXT')) for c in columns)))
+        conn.execute('CREATE INDEX {0}_group ON {0}({1})'.format(table, ', '.join(columns)))
+
+
+class AggregateCounts(object):
+    """Counts per AGGREGATE_TABLES group that have not been written to the database yet"""
+
+    def __init__(self):
+        self.counts = dict((table, defaultdict(int)) for table, _ in AGGREGATE_TABLES)
+        self.tables = dict((key, table) for table, key, _ in DB_TABLES)
+
+    def add(self, el, sign=1):
+        '''Count the rows of one shape_rows result; sign=-1 takes them back out'''
+        for key, rows in el.items():
+            if key in ENTITY_KEYS:
+                if rows[0] is None:
+                    continue
+                user = USER_FIELD[key]
+                _, year, month = time_columns(rows[-1])
+                uid = int(rows[user + 1]) if rows[user + 1] else None
+                self.counts['user_counts'][(key, rows[user], uid)] += sign
+                self.counts['month_counts'][(key, year, month)] += sign
+            elif key in TAG_ENTITY:
+                tags = self.counts['tag_counts']
+                entity = TAG_ENTITY[key]
+                for row in rows:
+                    tags[(entity, row[3], row[1], row[2])] += sign
+
+    def remove_stored(self, conn, kind, id_):
+        '''Take the element kind/id_ as it is stored in the database back out of the counts'''
+        row = conn.execute('SELECT user, uid, year, month FROM {} WHERE id = ?'.format(self.tables[kind]),
+                           (id_,)).fetchone()
+        if row:
+            self.counts['user_counts'][(kind, row[0], row[1])] -= 1
+            self.counts['month_counts'][(kind, row[2], row[3])] -= 1
+        tags = self.counts['tag_counts']
+        for type_, key, value in conn.execute('SELECT type, key, value FROM {} WHERE id = ?'.format(
+                                              self.tables[ENTITY_TAGS[kind]]), (id_,)):
+            tags[(kind, type_, key, value)] -= 1
+
+    def size(self):
+        return max(len(counts) for counts in self.counts.values())
+
+    def write(self, conn):
+        '''Add the waiting counts to the summary tables and start again from zero'''
+        for table, columns in AGGREGATE_TABLES:
+            # IS rather than = so that groups with a NULL (no timestamp, no user) are matched too
+            update = 'UPDATE {} SET num = num + ? WHERE {}'.format(
+                table, ' AND '.join('{} IS ?'.format(c) for c in columns))
+            insert = 'INSERT INTO {} VALUES ({})'.format(table, ', '.join('?' * (len(columns) + 1)))
+            for group, num in self.counts[table].iteritems():
+                if num and not conn.execute(update, (num,) + group).rowcount:
+                    conn.execute(insert, group + (num,))
+            conn.execute('DELETE FROM {} WHERE num <= 0'.format(table))
+            self.counts[table].clear()
+
+
+def refresh_aggregates(db_path=DB_PATH):
+    '''Rebuild the summary tables from the nodes, ways and relations tables and their tags'''
+    conn = sqlite3.connect(db_path)
+    create_aggregate_tables(conn)
+    tables = dict((key, table) for table, key, _ in DB_TABLES)
+    for entity in ENTITY_KEYS:
+        conn.execute('''INSERT INTO user_counts SELECT ?, user, uid, COUNT(*) FROM {}
+                        WHERE id IS NOT NULL GROUP BY user, uid'''.format(tables[entity]), (entity,))
+        conn.execute('''INSERT INTO month_counts SELECT ?, year, month, COUNT(*) FROM {}
+                        WHERE id IS NOT NULL GROUP BY year, month'''.format(tables[entity]), (entity,))
+        conn.execute('''INSERT INTO tag_counts SELECT ?, type, key, value, COUNT(*) FROM {}
+                        GROUP BY type, key, value'''.format(tables[ENTITY_TAGS[entity]]), (entity,))
+    conn.commit()
+    conn.close()
+
+#if __name__ == '__main__':
+#    refresh_aggregates()
+
+
+class SQLiteLoader(object):
+    """Insert shape_element output into a sqlite database in large batches
+
+    Rows are buffered per table and written with executemany every batch_size
+    rows; the transaction is committed every rows_per_commit rows.  The
+    summary tables are kept up to date with AggregateCounts as rows come in.
+    """
+
+    def __init__(self, db_path=DB_PATH, batch_size=BATCH_SIZE, rows_per_commit=ROWS_PER_COMMIT):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.isolation_level = None  # transactions are handled here, not by the sqlite3 module
+        self.conn.text_factory = str  # accept the utf-8 byte strings from the expat backend
+        for pragma in BULK_PRAGMAS:
+            self.conn.execute(pragma)
+        create_tables(self.conn)
+        create_aggregate_tables(self.conn)
+        self.aggregates = AggregateCounts()
+        self.batch_size = batch_size
+        self.rows_per_commit = rows_per_commit
+        self.fields = dict((key, fields) for _, key, fields in DB_TABLES)
+        self.inserts = dict((key, 'INSERT INTO {} VALUES ({})'.format(
+                            table, ', '.join('?' * len(table_columns(key, fields)))))
+                            for table, key, fields in DB_TABLES)
+        self.batches = defaultdict(list)
+        self.uncommitted = 0
+        self.conn.execute('BEGIN')
+
+    def add(self, el):
+        '''Queue the rows of one shape_rows result'''
+        for kind in ENTITY_KEYS:
+            if kind in el and el[kind][0] is None:  # a node without all 8 attributes, as in apply_changes
+                return
+        for key, rows in el.items():
+            batch = self.batches[key]
+            if key in ENTITY_KEYS:
+                batch.append(rows + time_columns(rows[-1]))  # timestamp is the last field
+            else:
+                batch.extend(rows)
+            if len(batch) >= self.batch_size:
+                self.flush(key)
+        self.aggregates.add(el)
+        if self.aggregates.size() >= AGGREGATE_FLUSH:
+            self.aggregates.write(self.conn)
+
+    def flush(self, key):
+        batch = self.batches[key]
+        if batch:
+            self.conn.executemany(self.inserts[key], batch)
+            self.uncommitted += len(batch)
+            del batch[:]
+        if self.uncommitted >= self.rows_per_commit:
+            self.conn.execute('COMMIT')
+            self.conn.execute('BEGIN')
+            self.uncommitted = 0
+
+    def close(self):
+        for key in self.fields:
+            self.flush(key)
+        self.aggregates.write(self.conn)
+        self.conn.execute('COMMIT')
+        self.conn.close()
+
+
+def load_db(file_in, db_path=DB_PATH, indexes=True, backend='iterparse', clip=None):
+    '''Shape every element of file_in (inside the ClipArea clip, if given) and load it into db_path, then index it'''
+    loader = SQLiteLoader(db_path)
+    stage = instrumentation.stage('load_db', file_in) if instrumentation.enabled else None
+    elements = get_element(stage.source(file_in) if stage else file_in, tags=('node', 'way', 'relation'),
+                           backend=backend)
+    if clip is not None:
+        elements = clip_elements(elements, Clipper(clip))
+    try:
+        if stage is None:
+            for element in elements:
+                el = shape_rows(element)
+                if el:
+                    loader.add(el)
+        else:
+            stage.run(elements, shape_rows, lambda element, el: el and loader.add(el))
+    finally:
+        loader.close()
+        if stage is not None:
+            stage.finish()
+    tag_keys.report()
+    if indexes:
+        build_indexes(db_path)
+        build_spatial_index(db_path)
+
+#if __name__ == '__main__':
+#    load_db(in_file)
+
+
+# None of the questions so far use location, because "what is near here" meant scanning all 7.2M
+# nodes.  build_spatial_index() adds two SQLite rtree tables at the end of load_db: one with a
+# point for every node and one with the bounding box of every way, worked out from ways_nodes.
+# nodes_in_bbox/nodes_near and ways_in_bbox/ways_near use those tables and can be joined with a tag,
+# e.g. every cuisine=indian node within 2 km of Pike Place Market.
+
+# In[ ]:
+
+SPATIAL_TABLES = ['nodes_rtree', 'ways_rtree']
+
+NODE_POINTS_SQL = '''SELECT id, lat, lat, lon, lon FROM nodes WHERE lat IS NOT NULL AND lon IS NOT NULL'''
+
+WAY_BOXES_SQL = '''SELECT wn.id, min(n.lat), max(n.lat), min(n.lon), max(n.lon)
+                   FROM ways_nodes wn JOIN nodes n ON n.id = wn.node_id'''
+
+
+def build_spatial_index(db_path=DB_PATH):
+    '''(Re)build nodes_rtree and ways_rtree from the nodes and ways_nodes tables'''
+    conn = sqlite3.connect(db_path)
+    for pragma in BULK_PRAGMAS:
+        conn.execute(pragma)
+    for table in SPATIAL_TABLES:
+        conn.execute('DROP TABLE IF EXISTS {}'.format(table))
+        conn.execute('CREATE VIRTUAL TABLE {} USING rtree(id, min_lat, max_lat, min_lon, max_lon)'.format(table))
+    conn.execute('INSERT INTO nodes_rtree ' + NODE_POINTS_SQL)
+    conn.execute('INSERT INTO ways_rtree ' + WAY_BOXES_SQL + ' GROUP BY wn.id')
+    conn.commit()
+    conn.close()
+
+
+def update_spatial_index(conn, node_ids, way_ids):
+    '''Bring the rtree tables up to date after the given nodes and ways have changed
+
+    Ways that use one of the nodes get their bounding box recomputed as well.
+    Does nothing if build_spatial_index has not been run on the database.
+    '''
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'nodes_rtree'").fetchone():
+        return
+    way_ids = set(way_ids)
+    for id_ in node_ids:
+        conn.execute('DELETE FROM nodes_rtree WHERE id = ?', (id_,))
+        conn.execute('INSERT INTO nodes_rtree ' + NODE_POINTS_SQL + ' AND id = ?', (id_,))
+        way_ids.update(row[0] for row in conn.execute('SELECT id FROM ways_nodes WHERE node_id = ?', (id_,)))
+    for id_ in way_ids:
+        conn.execute('DELETE FROM ways_rtree WHERE id = ?', (id_,))
+        conn.execute('INSERT INTO ways_rtree ' + WAY_BOXES_SQL + ' WHERE wn.id = ? GROUP BY wn.id', (id_,))
+
+
+def radius_bbox(lat, lon, radius):
+    '''Return (min_lat, min_lon, max_lat, max_lon) of a box that holds the circle of radius metres'''
+    dlat = math.degrees(radius / EARTH_RADIUS)
+    dlon = dlat / max(math.cos(math.radians(lat)), 1e-12)
+    return (lat - dlat, lon - dlon, lat + dlat, lon + dlon)
+
+
+def distance(lat1, lon1, lat2, lon2):
+    '''Great circle distance in metres (haversine)'''
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2 +
+         math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def tag_join(tags_table, key, value):
+    '''SQL and parameters to keep only ids with tag key (=value, if given)'''
+    if key is None:
+        return '', ()
+    if value is None:
+        return ' JOIN {} t ON t.id = r.id AND t.key = ?'.format(tags_table), (key,)
+    return ' JOIN {} t ON t.id = r.id AND t.key = ? AND t.value = ?'.format(tags_table), (key, value)
+
+
+def nodes_in_bbox(conn, min_lat, min_lon, max_lat, max_lon, key=None, value=None):
+    '''Return (id, lat, lon) of the nodes inside the box, optionally only those with tag key=value'''
+    join, params = tag_join('nodes_tags', key, value)
+    sql = ('SELECT DISTINCT n.id, n.lat, n.lon FROM nodes_rtree r JOIN nodes n ON n.id = r.id' + join +
+           ' WHERE r.min_lat <= ? AND r.max_lat >= ? AND r.min_lon <= ? AND r.max_lon >= ?'
+           ' AND n.lat BETWEEN ? AND ? AND n.lon BETWEEN ? AND ?')
+    return conn.execute(sql, params + (max_lat, min_lat, max_lon, min_lon,
+                                       min_lat, max_lat, min_lon, max_lon)).fetchall()
+
+
+def nodes_near(conn, lat, lon, radius, key=None, value=None):
+    '''Return (id, lat, lon, metres) of the nodes within radius metres of lat/lon, nearest first'''
+    found = []
+    for id_, n_lat, n_lon in nodes_in_bbox(conn, *radius_bbox(lat, lon, radius), key=key, value=value):
+        d = distance(lat, lon, n_lat, n_lon)
+        if d <= radius:
+            found.append((id_, n_lat, n_lon, d))
+    found.sort(key=operator.itemgetter(3))
+    return found
+
+
+def ways_in_bbox(conn, min_lat, min_lon, max_lat, max_lon, key=None, value=None):
+    '''Return (id, min_lat, max_lat, min_lon, max_lon) of the ways whose bounding box overlaps the box'''
+    join, params = tag_join('ways_tags', key, value)
+    sql = ('SELECT DISTINCT r.id, r.min_lat, r.max_lat, r.min_lon, r.max_lon FROM ways_rtree r' + join +
+           ' WHERE r.min_lat <= ? AND r.max_lat >= ? AND r.min_lon <= ? AND r.max_lon >= ?')
+    return conn.execute(sql, params + (max_lat, min_lat, max_lon, min_lon)).fetchall()
+
+
+def ways_near(conn, lat, lon, radius, key=None, value=None):
+    '''Return (id, metres) of the ways whose bounding box comes within radius metres of lat/lon, nearest first'''
+    found = []
+    for id_, min_lat, max_lat, min_lon, max_lon in ways_in_bbox(conn, *radius_bbox(lat, lon, radius),
+                                                                key=key, value=value):
+        # nearest point of the bounding box
+        d = distance(lat, lon, min(max(lat, min_lat), max_lat), min(max(lon, min_lon), max_lon))
+        if d <= radius:
+            found.append((id_, d))
+    found.sort(key=operator.itemgetter(1))
+    return found
+
+# every indian restaurant within 2 km of Pike Place Market:
+#   nodes_near(conn, 47.6097, -122.3422, 2000, 'cuisine', 'indian')
+
+
+# Keeping the database current used to mean downloading the whole extract again and rebuilding
+# everything.  apply_changes() reads an osmChange (.osc) diff instead and applies its create, modify
+# and delete blocks to seattle.db.  Each change is checked against the version already stored, so a
+# diff that is applied twice, or out of order, never replaces a newer element with an older one.
+# Only the elements in the diff go through the street name fixes and the tag clean up.
+
+# In[ ]:
+
+OSC_ACTIONS = ('create', 'modify', 'delete')
+
+# shape_element keys of the child rows of each element type
+CHILD_KEYS = {'node': ['node_tags'],
+              'way': ['way_nodes', 'way_tags'],
+              'relation': ['rel_members', 'rel_tags']}
+
+
+def osc_changes(osc_file):
+    '''Yield (action, element) for every node, way and relation in an osmChange file (.osc, .osc.gz...)'''
+    source = open_osm(osc_file) if is_compressed(osc_file) else osc_file
+    try:
+        context = ET.iterparse(source, events=('start', 'end'))
+        _, root = next(context)
+        action, block = None, root
+        for event, elem in context:
+            if event == 'start':
+                if elem.tag in OSC_ACTIONS:
+                    action, block = elem.tag, elem
+            elif elem.tag in ENTITY_KEYS:
+                yield action, elem
+                block.clear()
+            elif elem.tag in OSC_ACTIONS:
+                action, block = None, root
+                root.clear()
+    finally:
+        if source is not osc_file:
+            source.close()
+
+
+def apply_changes(osc_file, db_path=DB_PATH, edit=fix_street_names):
+    '''Apply an osmChange file to a database built by load_db
+
+    create and modify replace the stored element and all of its child rows if
+    the change has a higher version; delete removes them unless the stored
+    version is newer.  The spatial index and the summary tables are updated for
+    the changed elements.  Everything runs in one transaction.  Returns the number
+    of changes applied per action and the number skipped as stale.
+    '''
+    tables = dict((key, table) for table, key, _ in DB_TABLES)
+    inserts = dict((key, '{} INTO {} VALUES ({})'.format(
+                   'INSERT OR REPLACE' if key in ENTITY_KEYS else 'INSERT', table,
+                   ', '.join('?' * len(table_columns(key, fields)))))
+                   for table, key, fields in DB_TABLES)
+    counts = defaultdict(int)
+    touched = defaultdict(set)
+    conn = sqlite3.connect(db_path)
+    conn.isolation_level = None
+    conn.text_factory = str
+    aggregates = AggregateCounts() if table_exists(conn, 'user_counts') else None
+    conn.execute('BEGIN')
+    try:
+        for action, elem in osc_changes(osc_file):
+            kind = elem.tag
+            id_ = int(elem.attrib['id'])
+            version = int(elem.attrib['version']) if 'version' in elem.attrib else None
+            row = conn.execute('SELECT version FROM {} WHERE id = ?'.format(tables[kind]), (id_,)).fetchone()
+            stored = row[0] if row else None
+            if action == 'delete':
+                if stored is None or (version is not None and stored > version):
+                    counts['skipped'] += 1
+                    continue
+            else:
+                if stored is not None and version is not None and stored >= version:
+                    counts['skipped'] += 1
+                    continue
+                if edit:
+                    edit(elem)
+                el = shape_rows(elem)
+                if el[kind][0] is None:  # same as process_map: nodes without all 8 attributes are left out
+                    counts['skipped'] += 1
+                    continue
+            if aggregates and stored is not None:
+                aggregates.remove_stored(conn, kind, id_)
+            for key in CHILD_KEYS[kind]:
+                conn.execute('DELETE FROM {} WHERE id = ?'.format(tables[key]), (id_,))
+            if action == 'delete':
+                conn.execute('DELETE FROM {} WHERE id = ?'.format(tables[kind]), (id_,))
+            else:
+                conn.execute(inserts[kind], el[kind] + time_columns(el[kind][-1]))
+                for key in CHILD_KEYS[kind]:
+                    conn.executemany(inserts[key], el[key])
+                if aggregates:
+                    aggregates.add(el)
+            counts[action] += 1
+            touched[kind].add(id_)
+        update_spatial_index(conn, touched['node'], touched['way'])
+        if aggregates:
+            aggregates.write(conn)
+        conn.execute('COMMIT')
+    except:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+    return dict(counts)
+
+#if __name__ == '__main__':
+#    apply_changes('seattle-daily.osc')
+
+
+# The only way to see how fast (or how big) any of this is has been to run it on the 1.61 GB
+# download.  generate_osm() writes a synthetic OSM file of about any size instead, drawn from the
+# element mix, tag counts, tag key/value pairs, nd counts, users, versions and timestamps of a
+# model file (seattle_sample.osm by default).  Whatever the model doesn't have examples of - the
+# sample has no relations and no tagged nodes - comes from SYNTHETIC_DEFAULTS.  Consecutive nodes
+# are placed near each other and ways use runs of consecutive nodes, as in a real extract.
+# run_benchmarks() then times get_element, shape_element, process_map, write_new_file,
+# audit_k_name and load_db on each size, every stage in a fresh worker process so its peak memory
+# is its own, and saves the results as json so two versions can be compared with
+# compare_benchmarks().
+
+# In[ ]:
+
+SYNTHETIC_SIZES = {'1mb': 1024 ** 2, '100mb': 100 * 1024 ** 2, '2gb': 2 * 1024 ** 3}
+BENCHMARK_DIR = 'benchmark'
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# used for anything the model file has no examples of
+SYNTHETIC_DEFAULTS = {'mix': {'node': 0.88, 'way': 0.115, 'relation': 0.005},
+                      'tag_counts': {'node': [0] * 18 + [1, 2, 3, 5],
+                                     'way': [1, 2, 2, 3, 4, 5],
+                                     'relation': [2, 3, 4, 6]},
+                      'pairs': {'node': [('highway', 'crossing'), ('highway', 'bus_stop'),
+                                         ('amenity', 'restaurant'), ('cuisine', 'indian'),
+                                         ('cuisine', 'Nepalese,_Indian,_Tibetan'), ('shop', 'bakery'),
+                                         ('name', 'Pike Place Market'), ('addr:street', 'Pine St'),
+                                         ('addr:housenumber', '1530'), ('addr:postcode', '98101'),
+                                         ('addr:city', 'Seattle'), ('fixme', 'survey')],
+                                'way': [('highway', 'residential'), ('building', 'yes'),
+                                        ('name', 'Aurora Avenue North'), ('tiger:county', 'King, WA')],
+                                'relation': [('type', 'multipolygon'), ('type', 'route'), ('route', 'bus'),
+                                             ('building', 'yes'), ('name', 'Route 44'),
+                                             ('network', 'King County Metro')]},
+                      'nd_counts': [2, 2, 3, 4, 5, 5, 7, 9, 14, 25],
+                      'closed': 0.4,
+                      'member_counts': [2, 3, 5, 8, 20, 60],
+                      'members': [('way', 'outer'), ('way', 'inner'), ('way', ''), ('node', 'stop'),
+                                  ('node', 'platform'), ('relation', 'subarea')],
+                      'users': [('85280', 'tylerritchie'), ('147510', 'woodpeck_fixbot')],
+                      'versions': ['1', '1', '2', '3'],
+                      'bounds': (47.0, -123.8, 48.3, -121.0),
+                      'times': (1199145600, 1477353600)}  # 2008-01-01 to 2016-10-25
+
+
+def osm_profile(model_file=sample_file):
+    '''Distributions for generate_osm, read from model_file and topped up from SYNTHETIC_DEFAULTS'''
+    counts = defaultdict(int)
+    tag_counts = defaultdict(list)
+    pairs = defaultdict(list)
+    nd_counts, closed, member_counts, members = [], [], [], []
+    users, versions, lats, lons, times = [], [], [], [], []
+    for elem in get_element(model_file):
+        counts[elem.tag] += 1
+        tags = [(tag.attrib['k'], tag.attrib['v']) for tag in elem.findall('tag')]
+        tag_counts[elem.tag].append(len(tags))
+        pairs[elem.tag].extend(tags)
+        if 'user' in elem.attrib:
+            users.append((elem.attrib.get('uid', ''), elem.attrib['user']))
+        if 'version' in elem.attrib:
+            versions.append(elem.attrib['version'])
+        if 'timestamp' in elem.attrib:
+            times.append(time_columns(elem.attrib['timestamp'])[0])
+        if elem.tag == 'node':
+            lats.append(float(elem.attrib['lat']))
+            lons.append(float(elem.attrib['lon']))
+        elif elem.tag == 'way':
+            refs = [nd.attrib['ref'] for nd in elem.findall('nd')]
+            nd_counts.append(len(refs))
+            closed.append(len(refs) > 3 and refs[0] == refs[-1])
+        elif elem.tag == 'relation':
+            found = [(m.attrib['type'], m.attrib.get('role', '')) for m in elem.findall('member')]
+            member_counts.append(len(found))
+            members.extend(found)
+    defaults = SYNTHETIC_DEFAULTS
+    total = float(sum(counts.values()))
+    profile = {'mix': dict((kind, counts[kind] / total) for kind in ENTITY_KEYS) if total else {},
+               'tag_counts': {}, 'pairs': {},
+               'nd_counts': nd_counts or defaults['nd_counts'],
+               'closed': sum(closed) / float(len(closed)) if closed else defaults['closed'],
+               'member_counts': member_counts or defaults['member_counts'],
+               'members': members or defaults['members'],
+               'users': users or defaults['users'],
+               'versions': versions or defaults['versions'],
+               'bounds': (min(lats), min(lons), max(lats), max(lons)) if lats else defaults['bounds'],
+               'times': (min(times), max(times)) if times else defaults['times']}
+    for kind in ENTITY_KEYS:
+        if not counts[kind]:
+            profile['mix'][kind] = defaults['mix'][kind]
+        has_tags = any(tag_counts[kind])
+        profile['tag_counts'][kind] = tag_counts[kind] if has_tags else defaults['tag_counts'][kind]
+        profile['pairs'][kind] = pairs[kind] if has_tags else defaults['pairs'][kind]
+    total = sum(profile['mix'].values())
+    profile['mix'] = dict((kind, share / total) for kind, share in profile['mix'].items())
+    return profile
+
+
+class SyntheticOSM(object):
+    """Makes random OSMRecord nodes, ways and relations that follow an osm_profile()"""
+
+    def __init__(self, profile, seed=0):
+        self.profile = profile
+        self.rng = random.Random(seed)
+        self.min_lat, self.min_lon, self.max_lat, self.max_lon = profile['bounds']
+        self.lat = (self.min_lat + self.max_lat) / 2
+        self.lon = (self.min_lon + self.max_lon) / 2
+        self.changeset = 1000000
+
+    def attrib(self, id_):
+        rng = self.rng
+        uid, user = rng.choice(self.profile['users'])
+        self.changeset += rng.randint(0, 3)
+        stamp = time.strftime(TIMESTAMP_FORMAT, time.gmtime(rng.randint(*self.profile['times'])))
+        return {'id': str(id_), 'user': user, 'uid': uid, 'version': rng.choice(self.profile['versions']),
+                'changeset': str(self.changeset), 'timestamp': stamp}
+
+    def tags(self, kind):
+        rng = self.rng
+        pairs = self.profile['pairs'][kind]
+        n = min(rng.choice(self.profile['tag_counts'][kind]), len(pairs))
+        chosen = dict(rng.choice(pairs) for _ in range(n))  # one value per key, like real OSM
+        return [OSMRecord('tag', {'k': k, 'v': v}) for k, v in sorted(chosen.items())]
+
+    def node(self, id_):
+        rng = self.rng
+        if rng.random() < 0.02:  # start a new cluster somewhere else
+            self.lat = rng.uniform(self.min_lat, self.max_lat)
+            self.lon = rng.uniform(self.min_lon, self.max_lon)
+        else:
+            self.lat = min(max(self.lat + rng.gauss(0, 0.0005), self.min_lat), self.max_lat)
+            self.lon = min(max(self.lon + rng.gauss(0, 0.0005), self.min_lon), self.max_lon)
+        attrib = self.attrib(id_)
+        # as the OSM API writes them, without trailing zeros
+        attrib['lat'] = ('%.7f' % self.lat).rstrip('0').rstrip('.')
+        attrib['lon'] = ('%.7f' % self.lon).rstrip('0').rstrip('.')
+        return OSMRecord('node', attrib, self.tags('node'))
+
+    def way(self, id_, node_ids):
+        rng = self.rng
+        n = max(rng.choice(self.profile['nd_counts']), 2)
+        start = rng.randint(node_ids[0], max(node_ids[1] - n, node_ids[0]))
+        refs = range(start, min(start + n, node_ids[1] + 1))
+        if len(refs) > 2 and rng.random() < self.profile['closed']:
+            refs.append(refs[0])
+        nds = [OSMRecord('nd', {'ref': str(ref)}) for ref in refs]
+        return OSMRecord('way', self.attrib(id_), nds + self.tags('way'))
+
+    def relation(self, id_, ranges):
+        rng = self.rng
+        members = []
+        for _ in range(rng.choice(self.profile['member_counts'])):
+            kind, role = rng.choice(self.profile['members'])
+            first, last = ranges[kind]
+            if last >= first:
+                members.append(OSMRecord('member', {'type': kind, 'ref': str(rng.randint(first, last)),
+                                                    'role': role}))
+        return OSMRecord('relation', self.attrib(id_), members + self.tags('relation'))
+
+    def element(self, kind, id_, ranges):
+        if kind == 'node':
+            return self.node(id_)
+        if kind == 'way':
+            return self.way(id_, ranges['node'])
+        return self.relation(id_, ranges)
+
+
+def record_size(record):
+    parts = []
+    element_parts(record, parts)
+    return len(''.join(parts).encode('utf-8'))
+
+
+def generate_osm(out_file, size, profile=None, seed=0):
+    '''Write a synthetic OSM file of about size bytes (or a SYNTHETIC_SIZES name), return the element counts
+
+    The number of each element type comes from the profile's mix and the
+    average size of a trial batch of elements.  Node ids start at 1 and way
+    and relation ids follow on, so every ref points at an element in the file.
+    '''
+    size = SYNTHETIC_SIZES.get(size, size)
+    profile = profile or osm_profile()
+    trial = SyntheticOSM(profile, seed + 1)
+    ranges = {'node': (1, 1000), 'way': (1001, 1100), 'relation': (1101, 1110)}
+    per_element = sum(profile['mix'][kind] * sum(record_size(trial.element(kind, 0, ranges))
+                                                 for _ in range(200)) / 200.0
+                      for kind in ENTITY_KEYS)
+    total = max(int(size / per_element), 3)
+    counts = dict((kind, max(int(round(total * profile['mix'][kind])), 1)) for kind in ENTITY_KEYS)
+    ranges, first = {}, 1
+    for kind in ENTITY_KEYS:
+        ranges[kind] = (first, first + counts[kind] - 1)
+        first += counts[kind]
+    synthetic = SyntheticOSM(profile, seed)
+    with OSMWriter(out_file) as writer:
+        for kind in ENTITY_KEYS:
+            for id_ in xrange(ranges[kind][0], ranges[kind][1] + 1):
+                writer.write(synthetic.element(kind, id_, ranges))
+    return counts
+
+
+def synthetic_file(size, seed=0, model_file=sample_file, out_dir=BENCHMARK_DIR):
+    '''Path of the synthetic file for size, generating it the first time'''
+    path = os.path.join(out_dir, 'synthetic_{}_{}.osm'.format(size, seed))
+    if not os.path.exists(path):
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        generate_osm(path + '.part', size, osm_profile(model_file), seed)
+        os.rename(path + '.part', path)
+    return path
+
+
+def count_parsed(path):
+    return sum(1 for _ in get_element(path))
+
+
+def count_shaped(path):
+    n = 0
+    for element in get_element(path):
+        shape_element(element)
+        n += 1
+    return n
+
+
+def rewrite_file(path):
+    write_new_file(path, 'fixed.osm')
+
+
+def audit_streets(path):
+    audit_k_name(path, ['addr:street'])
+
+
+def audit_coordinates(path):
+    audit_lat_lon(path, 'node')
+
+
+def load_scratch_db(path):
+    load_db(path, 'benchmark.db')
+
+# stage name -> function of the input path; each one runs inside a scratch directory
+BENCHMARK_STAGES = {'get_element': count_parsed,
+                    'shape_element': count_shaped,
+                    'process_map': process_map,
+                    'write_new_file': rewrite_file,
+                    'audit_k_name': audit_streets,
+                    'audit_lat_lon': audit_coordinates,
+                    'load_db': load_scratch_db}
+BENCHMARK_ORDER = ['get_element', 'shape_element', 'process_map', 'write_new_file', 'audit_k_name',
+                   'load_db']
+
+
+def measure_stage(job):
+    '''Run one BENCHMARK_STAGES entry in a scratch directory, return its time and memory use'''
+    name, path = job
+    path = os.path.abspath(path)
+    workdir = tempfile.mkdtemp(prefix='osm_bench_')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        start_rss = current_rss() or peak_rss()
+        start = time.time()
+        result = BENCHMARK_STAGES[name](path)
+        seconds = time.time() - start
+        peak = peak_rss()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {'seconds': seconds, 'start_rss_mb': start_rss / 1048576.0, 'peak_rss_mb': peak / 1048576.0,
+            'growth_mb': max(peak - start_rss, 0) / 1048576.0,
+            'elements': result if isinstance(result, int) else None}
+
+
+def run_benchmarks(sizes=('1mb', '100mb'), stages=BENCHMARK_ORDER, label=None, repeat=1, seed=0,
+                   model_file=sample_file, out_dir=BENCHMARK_DIR):
+    """Time every stage on the synthetic file of each size and save the results to out_dir/label.json
+
+    Each run of each stage gets a new worker process; the fastest time and
+    the largest peak over repeat runs are kept.  peak_rss_mb includes what the
+    worker inherited from this process, growth_mb is what the stage added.
+    """
+    label = label or time.strftime('%Y%m%d-%H%M%S')
+    results = {'label': label, 'python': sys.version.split()[0], 'seed': seed, 'sizes': {}}
+    for size in sizes:
+        path = synthetic_file(size, seed, model_file, out_dir)
+        nbytes = os.path.getsize(path)
+        runs = defaultdict(list)
+        for _ in range(repeat):
+            for name in stages:
+                pool = multiprocessing.Pool(1)
+                try:
+                    runs[name].append(pool.apply(measure_stage, ((name, path),)))
+                finally:
+                    pool.close()
+                    pool.join()
+        elements = max([run['elements'] for name in stages for run in runs[name]] + [None])
+        by_stage = {}
+        for name in stages:
+            best = min(runs[name], key=operator.itemgetter('seconds'))
+            stage = dict(best, peak_rss_mb=max(run['peak_rss_mb'] for run in runs[name]),
+                         growth_mb=max(run['growth_mb'] for run in runs[name]),
+                         mb_per_sec=nbytes / 1048576.0 / best['seconds'], elements=elements)
+            if elements:
+                stage['elements_per_sec'] = elements / best['seconds']
+            by_stage[name] = stage
+            print '{:6} {:15} {:8.2f}s {:8.1f} MB/s  peak {:7.1f} MB  (+{:.1f} MB)'.format(
+                size, name, stage['seconds'], stage['mb_per_sec'], stage['peak_rss_mb'], stage['growth_mb'])
+        results['sizes'][size] = {'file': path, 'bytes': nbytes, 'stages': by_stage}
+    with open(os.path.join(out_dir, label + '.json'), 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    return results
+
+
+def compare_benchmarks(old_json, new_json):
+    '''Print time and peak memory of new_json relative to old_json for every size and stage they share'''
+    with open(old_json) as f:
+        old = json.load(f)
+    with open(new_json) as f:
+        new = json.load(f)
+    print '{} -> {}'.format(old['label'], new['label'])
+    for size in sorted(set(old['sizes']) & set(new['sizes'])):
+        before, after = old['sizes'][size]['stages'], new['sizes'][size]['stages']
+        for name in [name for name in BENCHMARK_ORDER if name in before and name in after]:
+            print '{:6} {:15} {:5.2f}x faster  {:7.1f} -> {:7.1f} MB peak'.format(
+                size, name, before[name]['seconds'] / after[name]['seconds'],
+                before[name]['peak_rss_mb'], after[name]['peak_rss_mb'])
+
+#if __name__ == '__main__':
+#    run_benchmarks(['1mb', '100mb', '2gb'], label='baseline')
+#    compare_benchmarks('benchmark/baseline.json', 'benchmark/<new label>.json')
+
+
+# check_memory() is the proof that the file scanning functions don't grow with the file: it runs
+# each of them on synthetic files of increasing size with memory_probe switched on and compares
+# how much memory each one added on the biggest file with what it added on the smallest.
+
+# In[ ]:
+
+MEMORY_STAGES = ['get_element', 'audit_k_name', 'audit_lat_lon', 'write_new_file', 'process_map']
+MEMORY_TOLERANCE_MB = 32
+
+
+def probe_stage(job):
+    '''measure_stage with memory_probe switched on'''
+    memory_probe.start(job[0])
+    try:
+        result = measure_stage(job)
+    finally:
+        stats = memory_probe.stop()
+    result.update(elements=stats['elements'], samples=stats['samples'], max_retained=stats['max_retained'],
+                  sampled_peak_mb=stats['peak_rss'] / 1048576.0)
+    return result
+
+
+def check_memory(sizes=('1mb', '100mb'), stages=MEMORY_STAGES, tolerance_mb=MEMORY_TOLERANCE_MB, seed=0,
+                 model_file=sample_file, out_dir=BENCHMARK_DIR):
+    """Run every stage on each size with memory_probe on, return {stage: True if its memory stayed flat}
+
+    A stage is flat if its growth_mb on the biggest file is within
+    tolerance_mb of the smallest, and the parser never held more elements at
+    once on the biggest file than on the smallest.
+    """
+    results = defaultdict(dict)
+    for size in sizes:
+        path = synthetic_file(size, seed, model_file, out_dir)
+        for name in stages:
+            pool = multiprocessing.Pool(1)
+            try:
+                result = pool.apply(probe_stage, ((name, path),))
+            finally:
+                pool.close()
+                pool.join()
+            results[name][size] = result
+            print '{:6} {:15} {:10,} elements  +{:7.1f} MB  at most {} element(s) held'.format(
+                size, name, result['elements'], result['growth_mb'], result['max_retained'])
+    flat = {}
+    for name in stages:
+        first, last = results[name][sizes[0]], results[name][sizes[-1]]
+        flat[name] = (last['growth_mb'] - first['growth_mb'] <= tolerance_mb and
+                      last['max_retained'] <= first['max_retained'])
+        print '{:15} {}'.format(name, 'flat' if flat[name] else 'GROWS')
+    return flat
+
+#check_memory(['1mb', '100mb', '2gb'])
+
+
 # # Finally, SQL queries
 # 
 
@@ -841,8 +4515,8 @@ df_yak = pd.DataFrame.from_records(yakima)
 df_yak.columns = ['id', 'value', 'key']
 print df_yak
 
-c.execute('''SELECT COUNT(*) FROM ways_tags
-               WHERE key = 'reviewed' AND value = 'no';''')
+c.execute('''SELECT COALESCE(SUM(num), 0) FROM tag_counts
+               WHERE entity = 'way' AND key = 'reviewed' AND value = 'no';''')
 not_rev = float(c.fetchall()[0][0])
 percent = round((not_rev/float(1048576))*100,2)
 print 'This many tags have not been reviewed: {}.'.format(not_rev)
@@ -906,6 +4580,94 @@ print 'This means that {}% may be inaccurate!!'.format(percent)
 # 313
 # 
 # 
+# The relations, nodes and ways sections below ask the same three questions, so the queries live in
+# REPORT_QUERIES and ReportRunner runs any of them for any of the entity types.  The queries go out
+# at the same time on a small pool of read-only connections (sqlite lets other threads run while it
+# works), so the whole set takes about as long as the slowest one.  Results are kept as DataFrames
+# until seattle.db changes on disk.
+
+# In[ ]:
+
+# report name -> (query, DataFrame columns); every query takes the entity type as its first parameter
+REPORT_QUERIES = {'users': ('''SELECT user, SUM(num) as num FROM user_counts
+                               WHERE entity = ?
+                               GROUP BY user
+                               ORDER BY num desc;''', ['user', 'count']),
+                  'months': ('''SELECT month, SUM(num) as num
+                                FROM month_counts
+                                WHERE entity = ? AND year = ?
+                                GROUP BY month;''', ['month', 'num_records']),
+                  'years': ('''SELECT year, SUM(num) as num
+                               FROM month_counts
+                               WHERE entity = ?
+                               GROUP BY year;''', ['year', 'num_records'])}
+REPORT_NAMES = ('users', 'months', 'years')
+REPORT_YEAR = 2015
+
+
+class ReportRunner(object):
+    """Run REPORT_QUERIES concurrently on a pool of read-only connections, caching the DataFrames
+
+    run() returns {(entity, report): DataFrame}.  The cache is dropped whenever
+    the modification time of the database file changes, i.e. after a load.
+    """
+
+    def __init__(self, db_path=DB_PATH, workers=4):
+        self.db_path = db_path
+        self.workers = workers
+        self.connections = Queue.Queue()
+        self.pool = ThreadPool(workers)
+        self.cache = {}
+        self.mtime = None
+
+    def connect(self):
+        '''(Re)open the connection pool, in case the database file has been replaced'''
+        self.close_connections()
+        for _ in range(self.workers):
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute('PRAGMA query_only = ON')
+            self.connections.put(conn)
+
+    def close_connections(self):
+        while not self.connections.empty():
+            self.connections.get().close()
+
+    def query(self, job):
+        report, params = job
+        sql, columns = REPORT_QUERIES[report]
+        conn = self.connections.get()
+        try:
+            rows = conn.execute(sql, params).fetchall()
+        finally:
+            self.connections.put(conn)
+        return pd.DataFrame.from_records(rows, columns=columns)
+
+    def run(self, entities=ENTITY_KEYS, reports=REPORT_NAMES, year=REPORT_YEAR):
+        mtime = os.path.getmtime(self.db_path)
+        if mtime != self.mtime:
+            self.cache.clear()
+            self.connect()
+            self.mtime = mtime
+        for name in reports:
+            if name not in REPORT_QUERIES:
+                raise ValueError('unknown report %r' % (name,))
+        # only the months report takes the year, so that is the only one cached per year
+        wanted = dict(((entity, report), (report, (entity, year) if report == 'months' else (entity,)))
+                      for entity in entities for report in reports)
+        jobs = [job for job in set(wanted.values()) if job not in self.cache]
+        for job, frame in zip(jobs, self.pool.map(self.query, jobs)):
+            self.cache[job] = frame
+        return dict((name, self.cache[job]) for name, job in wanted.items())
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.close_connections()
+
+reports = ReportRunner()
+frames = reports.run()
+
+
 # # Relations Information
 #  - ## How many records have been contributed by unique users?
 #  - ## How many records have been entered (total) each month in the year 2015? (for relations table)
@@ -914,39 +4676,17 @@ print 'This means that {}% may be inaccurate!!'.format(percent)
 
 # In[11]:
 
-c.execute('''SELECT DISTINCT user, count(*) as num FROM relations
-            GROUP BY user
-            ORDER BY num desc;''') 
-
-all_rows_rel = c.fetchall()
-
-df  = pd.DataFrame.from_records(all_rows_rel)
-rel_user_plot = df[0:20]
-rel_user_plot.columns = ['user', 'count']
+rel_user_plot = frames['relation', 'users'][0:20]
 rel_user_plot.plot(x='user', y = 'count', legend=False, kind='bar', ylim=(0,2150), title='RELATIONS users')
 
 
-c.execute('''SELECT strftime('%m', timestamp) as month, COUNT(id) as num
-             FROM relations
-             WHERE strftime('%Y', timestamp) = '2015'
-             GROUP BY month;''')
-
-rel_2015 = c.fetchall()
-rel_month_plot  = pd.DataFrame.from_records(rel_2015)
-rel_month_plot.columns = ['month', 'num_records']
+rel_month_plot = frames['relation', 'months']
 rel_month_plot.plot(x='month', y = 'num_records', legend=False, kind='bar', title='number of records entered in 2015 by month (relations)')
 
 #looks like February by far is the month with the highest number of records entered at least in 2015
 # How many records were input by year?
 
-c.execute('''SELECT strftime('%Y', timestamp) as year, COUNT(id) as num
-            FROM relations
-            GROUP BY year;''')
-rel_years = c.fetchall()
-
-rel_year_plot = pd.DataFrame.from_records(rel_years)
-rel_year_plot = rel_year_plot[0:11]
-rel_year_plot.columns = ['year', 'num_records']
+rel_year_plot = frames['relation', 'years'][0:11]
 rel_year_plot.plot(x='year', y='num_records', legend=False, kind='bar', title = 'number of records entered by year (relations)')
 
 
@@ -962,39 +4702,17 @@ rel_year_plot.plot(x='year', y='num_records', legend=False, kind='bar', title =
 
 # In[12]:
 
-c.execute('''SELECT DISTINCT user, count(*) as num FROM nodes
-            GROUP BY user
-            ORDER BY num desc;''') # use your column names here
-
-all_rows_nodes = c.fetchall()
-
-df  = pd.DataFrame.from_records(all_rows_nodes)
-node_user_plot = df[0:20]
-node_user_plot.columns = ['user', 'count']
+node_user_plot = frames['node', 'users'][0:20]
 node_user_plot.plot(x='user', y = 'count', legend=False, kind='bar', title='NODES users')
 
 
-c.execute('''SELECT strftime('%m', timestamp) as month, COUNT(id) as num
-             FROM nodes
-             WHERE strftime('%Y', timestamp) = '2015'
-             GROUP BY month;''')
-
-node_2015 = c.fetchall()
-node_month_plot  = pd.DataFrame.from_records(node_2015)
-node_month_plot.columns = ['month', 'num_records']
+node_month_plot = frames['node', 'months']
 node_month_plot.plot(x='month', y = 'num_records', legend=False, kind='bar', title='number of records entered in 2015 by month (nodes)')
 
 
 #looks like February by far is the month with the highest number of records entered at least in 2015
 # How many records were input by year?
-c.execute('''SELECT strftime('%Y', timestamp) as year, COUNT(id) as num
-            FROM nodes
-            GROUP BY year;''')
-node_years = c.fetchall()
-
-node_year_plot = pd.DataFrame.from_records(rel_years)
-node_year_plot = node_year_plot[0:11]
-node_year_plot.columns = ['year', 'num_records']
+node_year_plot = frames['node', 'years'][0:11]
 node_year_plot.plot(x='year', y='num_records', legend=False, kind='bar', title = 'number of records entered by year (nodes)')
 
 
@@ -1015,38 +4733,16 @@ node_year_plot.plot(x='year', y='num_records', legend=False, kind='bar', title =
 
 # In[13]:
 
-c.execute('''SELECT DISTINCT user, count(*) as num FROM ways
-            GROUP BY user
-            ORDER BY num desc;''') # use your column names here
-
-all_rows_ways = c.fetchall()
-
-df  = pd.DataFrame.from_records(all_rows_ways)
-way_user_plot = df[0:20]
-way_user_plot.columns = ['user', 'count']
+way_user_plot = frames['way', 'users'][0:20]
 way_user_plot.plot(x='user', y = 'count', legend=False, kind='bar', title='WAYS users')
 
-c.execute('''SELECT strftime('%m', timestamp) as month, COUNT(id) as num
-             FROM ways
-             WHERE strftime('%Y', timestamp) = '2015'
-             GROUP BY month;''')
-
-year_2015 = c.fetchall()
-way_month_plot  = pd.DataFrame.from_records(year_2015)
-way_month_plot.columns = ['month', 'num_records']
+way_month_plot = frames['way', 'months']
 way_month_plot.plot(x='month', y = 'num_records', legend=False, kind='bar', title='number of records entered in 2015 by month')
 
 
 #looks like February by far is the month with the highest number of records entered at least in 2015
 # How many records were input by year?
-c.execute('''SELECT strftime('%Y', timestamp) as year, COUNT(id) as num
-            FROM ways
-            GROUP BY year;''')
-all_years = c.fetchall()
-
-all_year_plot = pd.DataFrame.from_records(all_years)
-all_year_plot = all_year_plot[1:11]
-all_year_plot.columns = ['year', 'num_records']
+all_year_plot = frames['way', 'years'][0:11]
 all_year_plot.plot(x='year', y='num_records', legend=False, kind='bar', title = 'number of records entered by year')
 
 
@@ -1064,8 +4760,8 @@ all_year_plot.plot(x='year', y='num_records', legend=False, kind='bar', title =
 
 
 
-c.execute('''SELECT COUNT(*) as num, value FROM nodes_tags
-            WHERE key = "cuisine" 
+c.execute('''SELECT SUM(num) as num, value FROM tag_counts
+            WHERE entity = 'node' AND key = "cuisine" 
             GROUP BY value
             ORDER BY num desc;''')
 counts_rest = c.fetchall()
@@ -1075,8 +4771,8 @@ df.columns = ['counts', 'cuisine']
 df = df[0:20]
 df.plot(x = 'cuisine', y = 'counts', legend = False, kind = 'bar', title = 'number of restaurant types')
 
-c.execute('''SELECT count(id) FROM nodes_tags
-            WHERE key = "cuisine";''')
+c.execute('''SELECT SUM(num) FROM tag_counts
+            WHERE entity = 'node' AND key = "cuisine";''')
 
 total_cuisine= c.fetchall()
 
@@ -1124,6 +4820,7 @@ df.plot(x = 'cuisine', y = 'prop', legend = False, kind = 'bar', title = 'percen
 # In[38]:
 
 conn.close()
+reports.close()
 
 
 # In[ ]: